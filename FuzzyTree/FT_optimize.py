@@ -7,9 +7,16 @@ Created on Wed Sep  3 16:07:03 2014
 
 from .FuzzyVars import *
 from scipy.optimize import fmin_slsqp
-from numpy import percentile, array, diff
+from numpy import percentile, array, diff, unique, asarray, zeros, \
+    flatnonzero, ones, iterable, concatenate, sort, argsort, cumsum, interp, \
+    isnan, inf, searchsorted, vstack, minimum, newaxis, median, dot, sqrt, \
+    finfo, column_stack, asfortranarray, around
+from numpy.random import RandomState
+from .FT_pool import _SharedPool, _n_workers
+from time import perf_counter
 
-def optimize_partition(FClass, Variable, VarName, terms):
+def optimize_partition(FClass, Variable, VarName, terms, max_evals = None,
+                       max_time = None, report = None):
     '''Optimize the partition of a variable to reduce the ambiguity in the
     clasification of a Fuzzy Variable.
     
@@ -20,6 +27,13 @@ def optimize_partition(FClass, Variable, VarName, terms):
     - Variable : A real continuous variable that we want to Fuzzify
     - VarName : The name of the Fuzzy Variable
     - term : A set of linguistic terms representing the partition
+    - max_evals : Optional maximum number of evaluations of the objective
+    - max_time : Optional maximum time (seconds) of the optimization
+    - report: Optional dictionary. If provided, it is filled with the 
+              counters of the objective (see PartitionObjective.report)
+              
+    When a limit is reached the optimization stops, and the best parameters
+    evaluated up to then give the partition.
     
     
     Output
@@ -41,50 +55,39 @@ def optimize_partition(FClass, Variable, VarName, terms):
     IBV - Valencia (July 2014)   
     '''
     
-    the_var = Variable
-    the_Fclass = FClass
+    the_var = asarray(Variable)
     the_terms = terms
     the_Name = VarName
     nTerms = len(terms)
 
-    min_val = min(the_var)
-    max_val = max(the_var)
-
+    # This is the function to be optimized    
+    class_amb = PartitionObjective(FClass, the_var, nTerms)
     
     # This functions makes the optimization according to the parameters
     def do_fuzzification(p_pars):
-        fuzz_func = dict()
-        
-        # Parameters came proportional to the remaining segment
-        mini_val = min_val
-        D = max_val-mini_val
-        pars = []
-        for c in range(nTerms):
-            temp = D * p_pars[c] + mini_val
-            D = max_val - temp
-            mini_val = temp
-            
-            pars.append(temp)
-        
+        pars = class_amb.points(p_pars)
 
         # Creating the terms from the parameters
         fzFunc, fzVar = points_partition(the_var, the_Name, pars, the_terms)
         
         return (fzVar, fzFunc)
-
-    # This is the function to be optimized    
-    def class_amb(pars):
         
-        fzVar, temp = do_fuzzification(pars)
+    # Default values
+    default_pars, the_bounds = _default_pars(nTerms)
         
-        try:
-            out = ClassAmbiguity(the_Fclass, fzVar)
-        except:
-            out = 1
-            
-        return out
+    # Now we do the optimization
+    new_pars = _fit_partition(class_amb, default_pars, the_bounds, 
+                              max_evals, max_time)
+    
+    if report is not None: report.update(class_amb.report())
         
-    # Default values
+    fzVar, fzFunc = do_fuzzification(new_pars)
+    
+    return (fzFunc, fzVar)
+    
+def _default_pars(nTerms):
+    '''Starting parameters and bounds of optimize_partition'''
+    
     default_pars = []
     the_bounds = []
     
@@ -94,13 +97,494 @@ def optimize_partition(FClass, Variable, VarName, terms):
         default_pars.append(temp)
         the_bounds.append((0.1,0.9))
         
-    # Now we do the optimization
-    new_pars = fmin_slsqp(class_amb, x0 = default_pars, bounds = the_bounds)
+    return (default_pars, the_bounds)
+    
+class _BudgetExceeded(Exception):
+    '''The limits of evaluations or time of a PartitionObjective'''
+    pass
+    
+def _fit_partition(class_amb, x0, the_bounds, max_evals = None, 
+                   max_time = None, iprint = 1):
+    '''Minimizes a PartitionObjective from x0 within the limits. Stopped
+    by them, the best parameters evaluated are the result.'''
+    
+    class_amb.budget(max_evals, max_time)
+    
+    # The gradient has all the probes in one batch
+    try:
+        new_pars = fmin_slsqp(class_amb, x0 = x0, bounds = the_bounds,
+                              fprime = class_amb.gradient, iprint = iprint)
+    except _BudgetExceeded:
+        new_pars = class_amb.Best
+        if new_pars is None:
+            new_pars = x0
+            
+    return new_pars
+    
+def optimize_partitions(FClass, data_frame, terms, n_jobs = 1, restarts = 1,
+                        seed = None, max_evals = None, max_time = None, 
+                        report = None):
+    '''Optimize the partitions of several variables (as optimize_partition)
+    in parallel, against the same classification.
+    
+    Every variable is optimized from restarts starting points: the default
+    one of optimize_partition and random ones within the bounds. Each start
+    is a task for the pool of worker processes, and the best start of each
+    variable gives its partition. The classification and the variables are 
+    shared read-only by the workers through memory mapped files (see 
+    _SharedPool) instead of being sent with each task.
+    
+    Parameters
+    ==========
+    
+    - FClass : The Fuzzy variable representing the classification.
+    - data_frame : DataFrame (or dictionary of arrays) with the real 
+                   continuous variables to Fuzzify. The Fuzzy Variables are
+                   named as its columns
+    - terms : The linguistic terms of the partitions, or a dictionary with
+              the terms of each variable
+    - n_jobs : Number of worker processes. 1 optimizes in this process, and
+               negative values count from the number of CPUs (-1 all)
+    - restarts : Number of starting points of each variable
+    - seed : Seed of the random starting points
+    - max_evals, max_time : Optional limits of each start, as in 
+                            optimize_partition
+    - report : Optional dictionary. If provided, it is filled with the 
+               counters of each variable, added up over its starts (and 
+               stopped is the number of starts stopped by the limits)
+    
+    Output
+    =========
+    
+    - Dictionary with the pair (fuzzy_function, fuzzy_var) of each 
+      variable, as optimize_partition
+    
+    Usage
+    ==========
 
+    >>> partitions = optimize_partitions(FClass, data[varRHS], levels, 
+                                         n_jobs = -1, restarts = 4)
+    >>> fs = FuzzySet(FClass, *[fv for fn, fv in partitions.values()])
+    '''
+    
+    names = list(data_frame.keys())
+    if type(terms) != dict:
+        terms = dict((v, terms) for v in names)
         
-    fzVar, fzFunc = do_fuzzification(new_pars)
+    X = asfortranarray(column_stack([asarray(data_frame[v], dtype=float) 
+                                     for v in names]))
+    if X.shape[0] != len(FClass):
+        raise Exception("Sizes not compatible")
+        
+    # The starting points of every variable
+    random = RandomState(seed)
+    tasks = []
+    for c, v in enumerate(names):
+        default_pars, the_bounds = _default_pars(len(terms[v]))
+        tasks.append((c, len(terms[v]), default_pars))
+        for r in range(restarts - 1):
+            tasks.append((c, len(terms[v]), 
+                          list(random.uniform(0.1, 0.9, len(terms[v])))))
+            
+    n_jobs = _n_workers(n_jobs)
+    initargs = ((FClass.Name, list(FClass.keys())), (max_evals, max_time))
     
-    return (fzFunc, fzVar)
+    if n_jobs == 1:
+        _InitPartitionWorker(FClass.Matrix, X, *initargs)
+        try:
+            results = [_WorkerOptimize(task) for task in tasks]
+        finally:
+            _PARTITION_WORKER.clear()
+    else:
+        with _SharedPool(n_jobs, _InitPartitionWorker, [FClass.Matrix, X], 
+                         initargs) as pool:
+            results = list(pool.map(_WorkerOptimize, tasks))
+            
+    # The best start of each variable
+    best = dict()
+    for (c, nTerms, x0), (points, amb, counters) in zip(tasks, results):
+        if not(c in best) or (amb < best[c][1]):
+            best[c] = (points, amb)
+            
+        if report is not None:
+            total = report.setdefault(names[c], dict())
+            for k, value in counters.items():
+                total[k] = total.get(k, 0) + value
+            
+    output = dict()
+    for c, v in enumerate(names):
+        output[v] = points_partition(X[:, c], v, best[c][0], terms[v])
+        
+    return output
+    
+# Data of the worker processes of optimize_partitions
+_PARTITION_WORKER = dict()
+
+def _InitPartitionWorker(C, X, layout, limits):
+    '''Initialization of a worker process: the classification on the 
+    matrix C (with the name and terms in layout) and the variables X'''
+    
+    Name, keys = layout
+        
+    _PARTITION_WORKER["FClass"] = FuzzyVar.from_matrix(Name, keys, C)
+    _PARTITION_WORKER["X"] = X
+    _PARTITION_WORKER["objective"] = (None, None)
+    _PARTITION_WORKER["limits"] = limits
+    
+def _WorkerOptimize(task):
+    '''Optimizes the partition of a variable from a starting point, and
+    returns its points, ambiguity and the counters of the objective. The 
+    objective of the last variable is kept for its next starts.'''
+    
+    c, nTerms, x0 = task
+    
+    key, class_amb = _PARTITION_WORKER["objective"]
+    if key != (c, nTerms):
+        class_amb = PartitionObjective(_PARTITION_WORKER["FClass"], 
+                                       _PARTITION_WORKER["X"][:, c], nTerms)
+        _PARTITION_WORKER["objective"] = ((c, nTerms), class_amb)
+        
+    default_pars, the_bounds = _default_pars(nTerms)
+    new_pars = _fit_partition(class_amb, x0, the_bounds, 
+                              *_PARTITION_WORKER["limits"], iprint = 0)
+    
+    counters = class_amb.report()
+    counters["stopped"] = int(counters["stopped"])
+    
+    return (class_amb.points(new_pars), class_amb.evaluate([new_pars])[0],
+            counters)
+    
+class PartitionObjective(object):
+    '''Classification ambiguity of a classification given the partition of
+    a variable by points_partition, as a function of the parameters of 
+    optimize_partition (each point is placed at a proportion of the segment
+    between the previous one and the maximum).
+    
+    The variable is sorted once. The triangular terms are constant out of
+    the segments between consecutive points, so the objects there only 
+    contribute through prefix sums of the classification, and within a 
+    segment only its two terms are not null. If the classification is crisp
+    the segments are also solved with prefix sums (min(m, c) = m * c), 
+    otherwise their memberships are computed as arrays, and the segments are
+    kept for the evaluations that do not move them.
+    
+    The same pass gives the derivatives of the sigma counts with respect to
+    the points, so the gradient (for the fprime of fmin_slsqp) scores all 
+    its probes in one batch without going over the data again.
+    
+    The statistics are those of ClassAmbiguityFromStats. Partitions with an
+    empty term get an ambiguity of 1, as ClassAmbiguity failing in the 
+    original objective.
+    
+    The values and gradients are cached by the parameters rounded to 
+    decimals, since the optimizer often comes back to nearly the same 
+    ones. The evaluations can be limited in number and time (budget): 
+    beyond them the objective raises _BudgetExceeded, and Best holds the
+    best parameters evaluated.
+    
+    Parameters
+    ==========
+    
+    - FClass : The Fuzzy variable representing the classification
+    - Variable : The real continuous variable to be partitioned
+    - nTerms : The number of linguistic terms of the partition
+    - max_segments : Number of segments kept between evaluations
+    - decimals : Decimals of the parameters in the keys of the cache
+    
+    Usage
+    ==========
+    >>> objective = PartitionObjective(FClass, Variable, 3)
+    >>> ambiguity = objective([0.25, 0.33, 0.5])
+    >>> gradient = objective.gradient([0.25, 0.33, 0.5])
+    '''
+    
+    def __init__(self, FClass, Variable, nTerms, max_segments = 256, 
+                 decimals = 9):
+        x = asarray(Variable, dtype=float)
+        if len(x) != len(FClass):
+            raise Exception("Sizes not compatible")
+        
+        order = argsort(x, kind="stable")
+        x = x[order]
+        C = dequantize(FClass.Matrix)[order]
+        
+        self._nTerms = nTerms
+        self._min = x[0]
+        self._max = x[-1]
+        
+        # Centered, for the accuracy of the prefix sums
+        self._shift = median(x)
+        self._x = x - self._shift
+        self._C = C
+        self._crisp = bool(((C == 0.) | (C == 1.)).all())
+        
+        nClasses = C.shape[1]
+        self._cum_C = vstack([zeros((1, nClasses)), cumsum(C, axis=0)])
+        if self._crisp:
+            self._cum_x = concatenate([[0.], cumsum(self._x)])
+            self._cum_xC = vstack([zeros((1, nClasses)), 
+                                   cumsum(self._x[:, newaxis] * C, axis=0)])
+            
+        self._segments = dict()
+        self._max_segments = max_segments
+        
+        self._decimals = decimals
+        self._values = dict()
+        self._gradients = dict()
+        self.budget()
+        
+    def budget(self, max_evals = None, max_time = None):
+        '''Limits the number of evaluations and the time (seconds) from now 
+        on, and resets the counters of the report and Best (the cache is 
+        kept)'''
+        
+        self._max_evals = max_evals
+        self._max_time = max_time
+        self._start = perf_counter()
+        self._best = (inf, None)
+        self._report = dict(evaluations = 0, cache_hits = 0, gradients = 0,
+                            time = 0., stopped = False)
+        
+    def report(self):
+        '''Counters since the last budget: evaluations of the objective 
+        (evaluations), calls answered by the cache (cache_hits), gradients 
+        computed (gradients), the time spent in them (time) and whether the
+        limits were reached (stopped)'''
+        return dict(self._report)
+        
+    def _getbest(self):
+        return self._best[1]
+        
+    Best = property(_getbest, doc = "Best parameters evaluated since the "
+                                    "last budget")
+        
+    def _key(self, p_pars):
+        return tuple(around(asarray(p_pars, dtype=float), self._decimals))
+        
+    def _check_budget(self):
+        if ((self._max_evals is not None) and 
+            (self._report["evaluations"] >= self._max_evals)) or \
+           ((self._max_time is not None) and 
+            (perf_counter() - self._start >= self._max_time)):
+            self._report["stopped"] = True
+            raise _BudgetExceeded("Limit of the optimization reached")
+        
+    def points(self, p_pars):
+        '''Points of the partition given by the parameters'''
+        
+        # Parameters came proportional to the remaining segment
+        mini_val = self._min
+        D = self._max - mini_val
+        pars = []
+        for c in range(self._nTerms):
+            temp = D * p_pars[c] + mini_val
+            D = self._max - temp
+            mini_val = temp
+            
+            pars.append(temp)
+            
+        return pars
+        
+    def _segment(self, lo, hi):
+        '''Sums of the falling (f) and rising (r) terms of a segment, alone
+        and with every class (C). Besides Sum(f), Sum(min(f, C)), Sum(r) and
+        Sum(min(r, C)), it holds the sums of f and r where each minimum is 
+        the membership (f < C and r < C), for the derivatives.'''
+        
+        key = (lo, hi)
+        if key in self._segments:
+            return self._segments[key]
+        
+        a, b = searchsorted(self._x, [lo, hi])
+        d = hi - lo
+        nClasses = self._C.shape[1]
+        
+        if a == b:
+            stats = (0., zeros(nClasses), 0., zeros(nClasses)) * 2
+        elif self._crisp:
+            n = b - a
+            sx = self._cum_x[b] - self._cum_x[a]
+            sC = self._cum_C[b] - self._cum_C[a]
+            sxC = self._cum_xC[b] - self._cum_xC[a]
+            
+            fall_C = (hi * sC - sxC) / d
+            rise_C = (sxC - lo * sC) / d
+            
+            stats = ((hi * n - sx) / d, fall_C, (sx - lo * n) / d, rise_C,
+                     fall_C, rise_C, fall_C, rise_C)
+        else:
+            x = self._x[a:b, newaxis]
+            C = self._C[a:b]
+            
+            fall = (hi - x) / d
+            rise = (x - lo) / d
+            in_fall = fall < C
+            in_rise = rise < C
+            
+            stats = (fall.sum(), minimum(fall, C).sum(axis=0),
+                     rise.sum(), minimum(rise, C).sum(axis=0),
+                     (fall * in_fall).sum(axis=0), 
+                     (rise * in_fall).sum(axis=0),
+                     (fall * in_rise).sum(axis=0), 
+                     (rise * in_rise).sum(axis=0))
+        
+        if len(self._segments) >= self._max_segments:
+            self._segments.clear()
+        self._segments[key] = stats
+            
+        return stats
+        
+    def stats(self, points, derivatives = False):
+        '''Sigma counts of each term of the partition by the points, alone
+        and with every class. With derivatives, also their derivatives with
+        respect to each point (the memberships are piecewise linear in the
+        points and continuous, so only the objects within the segments 
+        count).'''
+        
+        m = asarray(points, dtype=float) - self._shift
+        nTerms = self._nTerms
+        nClasses = self._C.shape[1]
+        
+        sums = zeros(nTerms)
+        inter = zeros((nTerms, nClasses))
+        d_sums = zeros((nTerms, nTerms))
+        d_inter = zeros((nTerms, nClasses, nTerms))
+        
+        # Constant memberships: the first term below the first point and
+        # the last one from the last point
+        a, b = searchsorted(self._x, [m[0], m[-1]])
+        
+        sums[0] += a
+        inter[0] += self._cum_C[a]
+        sums[-1] += len(self._x) - b
+        inter[-1] += self._cum_C[-1] - self._cum_C[b]
+        
+        for c in range(nTerms - 1):
+            fall, fall_C, rise, rise_C, fall_Cf, fall_Cr, rise_Cf, rise_Cr = \
+                self._segment(m[c], m[c + 1])
+            
+            sums[c] += fall
+            inter[c] += fall_C
+            sums[c + 1] += rise
+            inter[c + 1] += rise_C
+            
+            # d f / d lo = f / d, d f / d hi = r / d, and r = 1 - f
+            d = m[c + 1] - m[c]
+            if d > 0.:
+                d_sums[c, c] += fall / d
+                d_sums[c, c + 1] += rise / d
+                d_sums[c + 1, c] -= fall / d
+                d_sums[c + 1, c + 1] -= rise / d
+                
+                d_inter[c, :, c] += fall_Cf / d
+                d_inter[c, :, c + 1] += fall_Cr / d
+                d_inter[c + 1, :, c] -= rise_Cf / d
+                d_inter[c + 1, :, c + 1] -= rise_Cr / d
+        
+        if derivatives:
+            return (sums, inter, d_sums, d_inter)
+            
+        return (sums, inter)
+        
+    def _points_jacobian(self, p_pars):
+        '''Derivatives of the points with respect to the parameters'''
+        
+        points = self.points(p_pars)
+        jac = zeros((self._nTerms, self._nTerms))
+        
+        previous = self._min
+        for c in range(self._nTerms):
+            jac[c, c] = self._max - previous
+            if c > 0:
+                jac[c, :c] = (1. - p_pars[c]) * jac[c - 1, :c]
+            previous = points[c]
+            
+        return jac
+        
+    def evaluate(self, pars):
+        '''Ambiguities of a batch of parameter vectors (one per row)'''
+        
+        sums, inter = [], []
+        for p in pars:
+            st = self.stats(self.points(p))
+            sums.append(st[0])
+            inter.append(st[1])
+            
+        output, valid = ClassAmbiguityFromStats([self._nTerms] * len(sums),
+                                                concatenate(sums), 
+                                                vstack(inter))
+        
+        return output
+        
+    def __call__(self, p_pars):
+        key = self._key(p_pars)
+        if key in self._values:
+            self._report["cache_hits"] += 1
+            return self._values[key]
+            
+        self._check_budget()
+        
+        start = perf_counter()
+        value = self.evaluate([p_pars])[0]
+        self._report["time"] += perf_counter() - start
+        self._report["evaluations"] += 1
+        
+        self._values[key] = value
+        if value < self._best[0]:
+            self._best = (value, array(p_pars, dtype=float))
+        
+        return value
+        
+    def gradient(self, p_pars, epsilon = sqrt(finfo(float).eps)):
+        '''Gradient of the ambiguity with respect to the parameters (see
+        _gradient), cached and within the budget'''
+        
+        key = (self._key(p_pars), epsilon)
+        if key in self._gradients:
+            self._report["cache_hits"] += 1
+            return self._gradients[key].copy()
+            
+        self._check_budget()
+        
+        start = perf_counter()
+        value = self._gradient(p_pars, epsilon)
+        self._report["time"] += perf_counter() - start
+        self._report["gradients"] += 1
+        
+        self._gradients[key] = value
+        
+        return value.copy()
+        
+    def _gradient(self, p_pars, epsilon):
+        '''Gradient of the ambiguity with respect to the parameters. 
+        
+        The derivatives of the sigma counts are exact (where defined), and
+        they are propagated through the ambiguity by forward differences: 
+        the statistics of every probe are those of p_pars moved along their 
+        derivatives, and all of them are scored in one batch of 
+        ClassAmbiguityFromStats. It does not take any pass over the data
+        once p_pars has been evaluated.'''
+        
+        p_pars = asarray(p_pars, dtype=float)
+        nTerms = self._nTerms
+        
+        sums, inter, d_sums, d_inter = self.stats(self.points(p_pars), 
+                                                  derivatives = True)
+        jac = self._points_jacobian(p_pars)
+        d_sums = dot(d_sums, jac)
+        d_inter = dot(d_inter, jac)
+        
+        probe_sums = [sums] + [sums + epsilon * d_sums[:, k] 
+                               for k in range(nTerms)]
+        probe_inter = [inter] + [inter + epsilon * d_inter[:, :, k] 
+                                 for k in range(nTerms)]
+        
+        values, valid = ClassAmbiguityFromStats([nTerms] * (nTerms + 1),
+                                                concatenate(probe_sums),
+                                                vstack(probe_inter))
+        
+        return (values[1:] - values[0]) / epsilon
+        
     
 def points_partition(Variable, VarName, points, terms):
     '''Partition of a variable where splitting points are provided.
@@ -133,6 +617,15 @@ def points_partition(Variable, VarName, points, terms):
     IBV - Valencia (July 2014)   '''
     
 
+    fzFunc = _points_fuzzification(VarName, points, terms)
+    fzVar = fzFunc(Variable)
+        
+    
+    return (fzFunc, fzVar)
+    
+def _points_fuzzification(VarName, points, terms):
+    '''Fuzzification with the triangular terms of points_partition'''
+
     if len(terms) != len(points):
         raise("Inconsisten Dimensions")
 
@@ -150,11 +643,7 @@ def points_partition(Variable, VarName, points, terms):
             
         fuzz_func[terms[c]] = func
 
-    fzFunc = Fuzzification(VarName,**fuzz_func)
-    fzVar = fzFunc(Variable)
-        
-    
-    return (fzFunc, fzVar)
+    return Fuzzification(VarName,**fuzz_func)
 
 
 
@@ -163,12 +652,15 @@ def percentile_partition(Variable, VarName, terms):
     Each membership is designed to contain the same namber of samples within.
     The quantile dependes on the number of linguistic terms of the partition.
     If the number of partitions implies quantiles at the same point, the
-    number of terms is automatically decreased.
+    number of terms is automatically decreased (the list terms is not 
+    modified).
     
     Parameters
     ==========
     
-    - Variable : A real continuous variable that we want to Fuzzify
+    - Variable : A real continuous variable that we want to Fuzzify, or a
+                 QuantileSketch of it (for data too large to be held in 
+                 memory, given in chunks or from several workers)
     - VarName : The name of the Fuzzy Variable
     - term : A set of linguistic terms representing the partition
     
@@ -177,7 +669,8 @@ def percentile_partition(Variable, VarName, terms):
     =========
     
     - fuzzy_function : The fuzzyfication function
-    - fuzzy_var : The variable fuzzified according to the fuzzy_function
+    - fuzzy_var : The variable fuzzified according to the fuzzy_function 
+                  (None for a QuantileSketch)
     
     
     Usage
@@ -192,23 +685,187 @@ def percentile_partition(Variable, VarName, terms):
     IBV - Valencia (July 2014)   
     '''
     
-    nPoints = len(terms)
-    perc_pts = ((array(range(nPoints)) + 1.) / (nPoints + 1)) * 100.
-    cut_pts = [percentile(Variable, p) for p in perc_pts]
-    
-    if min(diff(cut_pts)) == 0.:
+    if type(Variable) == QuantileSketch:
+        sketch = Variable
+    else:
+        sketch = None
+        Variable = asarray(Variable)
+        
+    terms = list(terms)
+    
+    while True:
+        # All the cut points at once
+        nPoints = len(terms)
+        perc_pts = ((array(range(nPoints)) + 1.) / (nPoints + 1)) * 100.
+        if sketch is None:
+            cut_pts = list(percentile(Variable, perc_pts))
+        else:
+            cut_pts = list(sketch.percentile(perc_pts))
+        
+        if min(diff(cut_pts)) != 0.:
+            break
+        
         if len(terms) > 2:
             terms.remove(terms[1])
-            return percentile_partition(Variable, VarName, terms)
         else:
-            cut_pts = [min(Variable), max(Variable)]
+            if sketch is None:
+                cut_pts = [min(Variable), max(Variable)]
+            else:
+                cut_pts = [sketch.Min, sketch.Max]
+            break
         
     # Creating the terms from the parameters 
-    fzFunc, fzVar = points_partition(Variable, VarName, cut_pts, terms)
+    fzFunc = _points_fuzzification(VarName, cut_pts, terms)
+    
+    if sketch is None:
+        fzVar = fzFunc(Variable)
+    else:
+        fzVar = None
 
     return (fzFunc, fzVar)
     
     
+class QuantileSketch(object):
+    '''Summary of a numerical variable, of bounded size, to approximate its
+    quantiles. The values are added in chunks (update) and the sketches of 
+    different parts of the data can be merged (merge), so the variable 
+    never needs to be held in memory.
+    
+    It is a hierarchy of compactors (as in the KLL sketch): the values of
+    level h stand for 2^h values each. When a level holds more than size 
+    values, they are sorted and every other one is moved up to the next 
+    level. 
+    
+    Up to size values the quantiles are exact (as numpy.percentile). 
+    Otherwise the error of the rank of a quantile is bounded by 
+    n * L / size, where L is the number of levels (about log2(n / size)),
+    and it is usually much smaller: below 0.1% of n with the default size 
+    for normal or uniform data. The memory is about size * L values. NaN
+    values are ignored.
+    
+    Parameters
+    ==========
+    
+    - size : Number of values of each level
+    
+    Usage
+    ==========
+    >>> sketch = QuantileSketch()
+    >>> for chunk in pd.read_csv("big.csv", usecols = ["Temp"], 
+                                 chunksize = 100000):
+            sketch.update(chunk["Temp"])
+    >>> fzFunc, _ = percentile_partition(sketch, "Temp", levels)
+    '''
+    
+    def __init__(self, size = 4096):
+        self._size = size
+        self._levels = [zeros(0)]
+        self._offsets = [0]
+        self._count = 0
+        self._min = inf
+        self._max = -inf
+        
+    def update(self, values):
+        '''Adds a chunk of values'''
+        
+        values = asarray(values, dtype = float).ravel()
+        values = values[~isnan(values)]
+        if len(values) == 0:
+            return self
+        
+        self._count += len(values)
+        self._min = min(self._min, values.min())
+        self._max = max(self._max, values.max())
+        
+        self._levels[0] = concatenate([self._levels[0], values])
+        self._compact()
+        
+        return self
+        
+    def merge(self, other):
+        '''Adds the values summarized by another sketch'''
+        
+        while len(self._levels) < len(other._levels):
+            self._levels.append(zeros(0))
+            self._offsets.append(0)
+            
+        for h, level in enumerate(other._levels):
+            self._levels[h] = concatenate([self._levels[h], level])
+            
+        self._count += other._count
+        self._min = min(self._min, other._min)
+        self._max = max(self._max, other._max)
+        self._compact()
+        
+        return self
+        
+    def _compact(self):
+        h = 0
+        while h < len(self._levels):
+            level = self._levels[h]
+            
+            if len(level) > self._size:
+                level = sort(level)
+                
+                # An even number of values is halved, alternating the 
+                # values kept so that the errors cancel out
+                odd = len(level) % 2
+                pairs = level[odd:]
+                
+                if h + 1 == len(self._levels):
+                    self._levels.append(zeros(0))
+                    self._offsets.append(0)
+                    
+                self._levels[h + 1] = concatenate(
+                    [self._levels[h + 1], pairs[self._offsets[h]::2]])
+                self._offsets[h] = 1 - self._offsets[h]
+                self._levels[h] = level[:odd]
+                
+            h += 1
+            
+    def percentile(self, q):
+        '''Approximate percentiles (in [0, 100]) of the values'''
+        
+        if self._count == 0:
+            raise Exception("Empty sketch")
+        
+        # Exact while nothing has been compacted
+        if len(self._levels) == 1:
+            return percentile(self._levels[0], q)
+            
+        values = concatenate(self._levels)
+        weights = concatenate([ones(len(level)) * 2**h 
+                               for h, level in enumerate(self._levels)])
+        
+        order = argsort(values, kind = "stable")
+        values = values[order]
+        weights = weights[order]
+        
+        # Rank of the center of every value, in [0, n - 1]
+        ranks = cumsum(weights) - (weights + 1.) / 2.
+        total = weights.sum()
+        
+        output = interp(asarray(q, dtype = float) / 100. * (total - 1.), 
+                        ranks, values)
+        
+        return output.clip(self._min, self._max)
+        
+    def _getcount(self):
+        return self._count
+        
+    Count = property(_getcount, doc = "Number of values summarized")
+    
+    def _getmin(self):
+        return self._min
+        
+    Min = property(_getmin, doc = "Minimum of the values")
+    
+    def _getmax(self):
+        return self._max
+        
+    Max = property(_getmax, doc = "Maximum of the values")
+    
+    
 def C_crisp(category):
     '''Closure for fuzzy crisp functions'''
     the_category = category
@@ -225,7 +882,98 @@ def C_crisp(category):
             
     return output
 
-def crisp_partition(Variable, VarName, terms):
+class CrispFuzzification(Fuzzification):
+    '''Fuzzification of a categorical variable: every category is a 
+    linguistic term (its str), with membership 1 for the values equal to it
+    and 0 otherwise, as the C_crisp functions.
+    
+    Arrays are fuzzified factorizing the values once (unique values and the 
+    code of each value) and emitting the one-hot matrix of memberships, 
+    instead of calling every C_crisp function on every value. memberships
+    does the same for the terms used by a tree. The values 
+    out of the categories (for instance, new categories at prediction time)
+    have no membership to any term.
+    
+    Parameters
+    ==========
+    
+    - varName : The name of the Fuzzy variable resulting as output
+    - categories : The categories of the variable
+    - sparse : If True, arrays are fuzzified as a SparseFuzzyVar
+    '''
+    
+    def __init__(self, varName, categories, sparse = False):
+        Fuzzification.__init__(self, varName, 
+                               **dict((str(c), C_crisp(c)) 
+                                      for c in categories))
+        self._terms = [str(c) for c in categories]
+        self._column = dict((c, i) for i, c in enumerate(categories))
+        self._sparse = sparse
+        
+    def codes(self, values):
+        '''Column (term) of every value, -1 for the values that are not any
+        of the categories'''
+        
+        values = asarray(values)
+        
+        if values.dtype.kind in "biufUS":
+            uniq, inverse = unique(values, return_inverse = True)
+            lookup = asarray([self._column.get(u, -1) for u in uniq.tolist()],
+                             dtype = int)
+            return lookup[inverse.ravel()]
+        
+        # Arbitrary objects (such as the strings of a pandas column) are 
+        # factorized by pandas, which also takes mixed types and missing 
+        # values (code -1, looked up as the last entry)
+        from pandas import factorize
+        
+        inverse, uniq = factorize(values.ravel())
+        lookup = asarray([self._column.get(u, -1) for u in list(uniq)] + [-1],
+                         dtype = int)
+        return lookup[inverse]
+        
+    def __call__(self, value):
+        if iterable(value) & (type(value) != str):
+            codes = self.codes(value)
+            rows = flatnonzero(codes >= 0)
+            
+            if self._sparse:
+                return SparseFuzzyVar._from_pairs(self._varName, self._terms,
+                                                  len(codes), rows, 
+                                                  codes[rows], 
+                                                  ones(len(rows)))
+                
+            M = zeros((len(codes), len(self._terms)), order = "F")
+            M[rows, codes[rows]] = 1.
+            
+            return FuzzyVar.from_matrix(self._varName, self._terms, M)
+            
+        return Fuzzification.__call__(self, value)
+        
+    def membership(self, term, values):
+        '''Membership of an array of values to a single linguistic term'''
+        return (self.codes(values) == self._terms.index(term)).astype(float)
+        
+    def memberships(self, terms, values):
+        '''Membership of an array of values to several linguistic terms, as 
+        a dictionary by term. The values are factorized only once, and the 
+        memberships are the columns of a single one-hot matrix'''
+        
+        codes = self.codes(values)
+        
+        # Column of every category in the output (-1 if not requested)
+        columns = -ones(len(self._terms) + 1, dtype = int)
+        for c, t in enumerate(terms):
+            columns[self._terms.index(t)] = c
+        codes = columns[codes]
+        rows = flatnonzero(codes >= 0)
+        
+        M = zeros((len(codes), len(terms)), order = "F")
+        M[rows, codes[rows]] = 1.
+        
+        return dict((t, M[:, c]) for c, t in enumerate(terms))
+
+def crisp_partition(Variable, VarName, terms, sparse = False):
     '''Partition of a variable consisting of a set of different categories
     (such as in the case of gender).
 
@@ -235,18 +983,22 @@ def crisp_partition(Variable, VarName, terms):
     - Variable : A list with the Variable we want to fuzzify
     - VarName  : The name of the fuzzy variable
     - terms    : Categories of classification
+    - sparse   : If True, the variable is fuzzified as a SparseFuzzyVar
+    
+    Output
+    =========
+    
+    - Ffunc : The fuzzyfication function (a CrispFuzzification)
+    - Fvar : The variable fuzzified. The values that are not any of the 
+             categories have no membership to any term
 
     Usage
     =========
 
     >>> my_func, my_var = crisp_partition(Gender, "Gender", ["Man", "Woman"])
     '''
-
-    FuzzyCrisp = dict()
-    for term in terms:
-        FuzzyCrisp[str(term)] = C_crisp(term)
         
-    Ffunc = Fuzzification(VarName, **FuzzyCrisp)
+    Ffunc = CrispFuzzification(VarName, terms, sparse)
     
     Fvar = Ffunc(Variable)
         
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Pools of worker processes sharing read-only arrays through memory mapped
+.npy files.
+
+@author: jmbelda
+"""
+
+from numpy import save, load
+from concurrent.futures import ProcessPoolExecutor
+from tempfile import mkdtemp
+from shutil import rmtree
+import os
+
+def _n_workers(n_jobs):
+    '''Number of worker processes for n_jobs: negative values count from
+    the number of CPUs (-1 all of them)'''
+
+    if n_jobs < 0:
+        n_jobs = max(1, os.cpu_count() + 1 + n_jobs)
+
+    return n_jobs
+
+def _InitShared(initializer, filenames, initargs):
+    '''Initialization of a worker process: memory maps the shared arrays
+    and gives them to the initializer, before its other arguments'''
+
+    arrays = [load(f, mmap_mode = "r") for f in filenames]
+    initializer(*(arrays + list(initargs)))
+
+class _SharedPool(object):
+    '''Pool of worker processes sharing read-only arrays.
+
+    Every array is written once to a temporary .npy file that the workers
+    memory map, so that the data are shared instead of being sent to each
+    task. An array given as the name of a .npy file (such as the one of a
+    FuzzySet loaded memory mapped) is mapped from that file.
+
+    Parameters
+    ==========
+
+    - n_jobs : Number of worker processes
+    - initializer : Function run by every worker with the memory mapped
+                    arrays followed by initargs
+    - arrays : List of arrays (or names of .npy files) to share
+    - initargs : Other arguments of the initializer
+    '''
+
+    def __init__(self, n_jobs, initializer, arrays, initargs = ()):
+        self._folder = None
+
+        try:
+            filenames = []
+            for c, array in enumerate(arrays):
+                if type(array) == str:
+                    filenames.append(array)
+                    continue
+
+                if self._folder is None:
+                    self._folder = mkdtemp(prefix = "FuzzyTree_")
+                filename = os.path.join(self._folder, "array_%d.npy" % c)
+                save(filename, array)
+                filenames.append(filename)
+
+            self._executor = ProcessPoolExecutor(
+                max_workers = n_jobs, initializer = _InitShared,
+                initargs = (initializer, filenames, tuple(initargs)))
+        except:
+            self._remove()
+            raise
+
+    def map(self, fn, *iterables):
+        '''Runs fn on the workers, the results come in the order of the
+        arguments'''
+        return self._executor.map(fn, *iterables)
+
+    def close(self):
+        self._executor.shutdown()
+        self._remove()
+
+    def _remove(self):
+        if self._folder is not None:
+            rmtree(self._folder, ignore_errors = True)
+            self._folder = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
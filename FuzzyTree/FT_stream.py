@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming classification of large inputs, chunk by chunk.
+
+@author: jmbelda
+"""
+
+from .FuzzyTree import FuzzyTree
+import os
+
+def read_chunks(source, chunksize = 100000, **kargs):
+    '''Reads a CSV or Parquet file in chunks of rows.
+    
+    Parameters
+    ==========
+    
+    - source : Name of the file. Files ending in .parquet are read with 
+               pyarrow, any other as CSV with pandas
+    - chunksize : Number of rows of each chunk
+    - **kargs : Additional arguments for pandas.read_csv (such as index_col)
+    
+    Output
+    =========
+    
+    An iterator of pandas DataFrames
+    '''
+    
+    if str(source).lower().endswith(".parquet"):
+        from pyarrow.parquet import ParquetFile
+        
+        for batch in ParquetFile(source).iter_batches(batch_size = chunksize):
+            yield batch.to_pandas()
+    else:
+        from pandas import read_csv
+        
+        for chunk in read_csv(source, chunksize = chunksize, **kargs):
+            yield chunk
+    
+def stream_classify(ft, source, fuzzifications = None, chunksize = 100000,
+                    **kargs):
+    '''Fuzzifies and classifies an input chunk by chunk, so that the memory
+    needed depends on the size of the chunks and not on the whole input.
+    
+    Parameters
+    ==========
+    
+    - ft : A FuzzyTree
+    - source : A CSV or Parquet file name (or path), or an iterable of 
+               DataFrames with the raw values of the attributes of the tree
+    - fuzzifications : Dictionary with the Fuzzification object of each
+                       attribute. By default, the ones of the tree
+    - chunksize : Number of rows of each chunk when reading a file
+    - **kargs : Additional arguments for pandas.read_csv (such as index_col)
+    
+    Output
+    =========
+    
+    An iterator of DataFrames, one per chunk and with its index, with the
+    membership to each class and the predicted class (in a column named as
+    the classification variable)
+    
+    Usage
+    ==========
+
+    >>> for result in stream_classify(ft, "./demo/airquality.csv", 
+                                      chunksize = 50, index_col = 0):
+    >>>     print(result)
+    '''
+    
+    from pandas import DataFrame
+    
+    if type(ft) != FuzzyTree:
+        raise Exception("Invalid type for the FuzzyTree")
+        
+    if isinstance(source, (str, os.PathLike)):
+        source = read_chunks(source, chunksize, **kargs)
+        
+    for chunk in source:
+        Result = ft.predict_membership(chunk, fuzzifications)
+        terms = list(Result.keys())
+        
+        output = DataFrame(Result.Matrix, index = chunk.index, 
+                           columns = terms)
+        output[Result.Name] = [terms[c] for c in 
+                               ft._last_argmax(Result.Matrix)]
+        
+        yield output
+        
+def stream_classify_to_csv(ft, source, filename, fuzzifications = None,
+                           chunksize = 100000, **kargs):
+    '''Classifies an input chunk by chunk (see stream_classify) and writes
+    the results incrementally to a CSV file.
+    
+    Output
+    =========
+    
+    - nRows : The number of rows classified
+    
+    Usage
+    ==========
+
+    >>> stream_classify_to_csv(ft, "big_input.csv", "classified.csv")
+    '''
+    
+    nRows = 0
+    header = True
+    
+    for output in stream_classify(ft, source, fuzzifications, chunksize, 
+                                  **kargs):
+        output.to_csv(filename, mode = "w" if header else "a", 
+                      header = header)
+        header = False
+        nRows += len(output)
+        
+    return nRows
@@ -6,18 +6,27 @@ Created on Mon Jun 16 12:37:01 2014
 """
 
 from .FuzzyVars import *
-from numpy import zeros, isnan
+from numpy import zeros, isnan, maximum, minimum, asarray, column_stack, \
+    argmax, where, inf, newaxis
+from .FT_pool import _SharedPool, _n_workers
+from concurrent.futures import ProcessPoolExecutor
 
 class FuzzyTree(object):
     '''Creating a FuzzyTree Object:
     
     Parameters
     ============
-    - theFuzzySet : A FuzzySet object containing the data in which building the tree
+    - theFuzzySet : A FuzzySet object containing the data in which building the tree,
+                    or a FuzzyChunks for data that do not fit in memory
     - Beta        : Threshold level of truthness to become a Leaf
     - Alfa        : Minimum activation for reliable evidence
     - LHS         : Left Hand Side: The arguments of the rule
     - RHS         : The clasification FuzzyVar
+    - n_jobs      : Number of worker processes to build the tree. 1 (the
+                    default) builds it in the current process and -1 uses
+                    all the processors. The tree is the same in any case
+    - fuzzifications : Optional dictionary with the Fuzzification object of
+                    each attribute, used by predict and predict_membership
     
     Example
     ============
@@ -42,7 +51,8 @@ class FuzzyTree(object):
     IBV - Valencia (July 2014)   
     '''
     
-    def __init__(self, theFuzzySet, Beta, Alfa, LHS, RHS):
+    def __init__(self, theFuzzySet, Beta, Alfa, LHS, RHS, n_jobs = 1,
+                 fuzzifications = None):
         
 #        if type(theFuzzySet) != FuzzySet:
 #            raise Exception("Invalidy type for the Fuzzy Set")
@@ -53,10 +63,18 @@ class FuzzyTree(object):
         self._FuzzySet = theFuzzySet
         self._Leaves = [] # These are the leaves of the tree
         
-        self._LHS = LHS  # Precedentes
+        self._LHS = list(LHS)  # Precedentes
         self._RHS = RHS # Consequente
+        self._Fuzzifications = fuzzifications
+        
+        # Terms of the classification
+        self._Classes = list(dict(theFuzzySet.layout())[RHS])
+        
+        self._n_jobs = _n_workers(n_jobs)
         
         self._createTree()
+        self._Plan = self._compile()
+        self._Rules = None
         
     def GetNodeParent(self):
         return self._NodeParent
@@ -70,12 +88,29 @@ class FuzzyTree(object):
         
         C = self._RHS #FuzzyVar classification
         
-        fs_C = theFuzzySet[C]
-        
         all_vars = set(self._LHS) # All the memberships
         
         #all_vars = all_vars - set([C])
         
+        # Data out of core are processed from their sufficient statistics
+        if isinstance(theFuzzySet, FuzzyChunks):
+            expander = _ChunkedExpander(theFuzzySet, C, self._Alfa, 
+                                        self._Beta, self._n_jobs)
+        elif self._n_jobs > 1:
+            expander = _FrontierPool(theFuzzySet, C, self._Alfa, self._Beta,
+                                     self._n_jobs)
+        else:
+            expander = _SerialExpander(theFuzzySet, C, self._Alfa, 
+                                       self._Beta)
+        
+        try:
+            self._expandTree(expander, all_vars)
+        finally:
+            expander.close()
+            
+    def _expandTree(self, expander, all_vars):
+        '''Induction of the tree, evaluating the nodes with an expander'''
+        
         #.....................................................................
         #STEP 1: Measure the classification ambiguity associated
         #        with each attribute
@@ -85,11 +120,7 @@ class FuzzyTree(object):
         
         mFvar = "" # Name of the FuzzyVar with less ambiguity
         
-        for P in self._LHS:
-            try:
-                FSamb = ClassAmbiguity(fs_C, theFuzzySet[P])
-            except:
-                FSamb = 1.
+        for P, FSamb in zip(self._LHS, expander.root(self._LHS)):
                 
             if not("mini" in locals()):
                 mini = FSamb
@@ -104,120 +135,124 @@ class FuzzyTree(object):
         
         NodeList = [self._NodeParent]
         
-        # This flag is for checking the creation of a node
-        NodeFlag = False
+        # Cache of the intersections (and their FuzzyEvidence2) computed 
+        # when scoring the attribute of a node, per node not yet expanded
+        Splits = dict()
+        
+        # Smallest ambiguity found (None if there is no one) and its 
+        # attribute. They are kept from branch to branch as in the former
+        # recursive version of the algorithm
+        target = None
+        ins_node = None
         
         #.....................................................................
         #STEP 3: Repeat step 2 for all newly generated decision nodes until
         # no further growth is possible, the decision tree then is complete.
-        for Node in NodeList:
-            #print NodeList
-        
-            # Current classification ambiguity
-            #curr_CA = ClassAmbiguity(fs_C, theFuzzySet[Node.Name])
-            curr_CA = Node.Truth
-            
-            #..................................................................
-            #STEP 2:
-            # Delete all empty branches of the decision node
-            kkName = Node.Name
-            P = self._FuzzySet[Node.Name]
-                    
-
-            #print Node.Name, C
-            for mu_k in theFuzzySet[Node.Name].keys():       
-                
-                # For each nonempty branch of the decision node, calculate the 
-                # truth level of classifying all objects within the branch
-                # into each class
-                
-                #tr_lev = dict() # Truth level
+        # The nodes are expanded frontier by frontier: the evaluation of the
+        # branches of the nodes of a frontier are independent, while the
+        # decisions are taken sequentially in the order of NodeList
+        first = 0
+        while first < len(NodeList):
+            frontier = NodeList[first:]
+            first = len(NodeList)
+            
+            tasks = [self._NodeTask(Node, all_vars, Splits.pop(Node, dict()))
+                     for Node in frontier]
+            
+            results = expander.map(tasks)
+            
+            for Node, task, branches in zip(frontier, tasks, results):
                 
-                # The membership partitition
-                try:
-                    mu = Node.mu(theFuzzySet)
-                except (KeyError):
-                    mu = None
-                #print Node
+                # Current classification ambiguity
+                curr_CA = Node.Truth
                 
-                # Member function includes the branch
-                mu = P[mu_k] & mu
+                # These are the FuzzyVars not included in the tree
+                new = task[4]
                 
-                if max(mu) < self._Alfa:
-                    continue
-
-                try:
-                    Fz_ev = FuzzyEvidence2(fs_C, mu)
-                except(ZeroDivisionError):
-                    continue
+                #..........................................................
+                #STEP 2:
+                # Delete all empty branches of the decision node
+                for mu_k, branch in branches:
                     
-                tr_lev = max(Fz_ev.values())
-                
-                if tr_lev == 0: continue
-                
-                if tr_lev > self._Beta:
-                    self._SelectNode(Fz_ev,Node,mu_k)
-                    continue
+                    if branch is None: continue
                     
-                # Otherwise, investigate if an additional attribute will further
-                # partition the branch (i.e. generate more than one nonempty 
-                # branch) and further reduce the classification ambiguity
+                    Fz_ev = branch["Fz_ev"]
                     
-#                if NodeFlag:
-#                    NodeFlag = False
-#                    continue
+                    # Leaf by truth level or because all variables are 
+                    # already included
+                    if not("ambs" in branch):
+                        self._SelectNode(Fz_ev,Node,mu_k)
+                        continue
+                        
+                    # Otherwise, investigate if an additional attribute 
+                    # will further partition the branch and further 
+                    # reduce the classification ambiguity
                     
-                v = Node.FVAncestors
-                # A flag for recursion on ambiguity
-                AmbRed = False
-                # These are the FuzzyVars not included in the tree
-                new = (all_vars - v)
-                # We remove also current node
-                new = list(new - set([Node.Name]))
-                # If all variables are already included we move to the next
-                if len(new) == 0:
-                    Fz_ev = FuzzyEvidence2(fs_C, mu)
-                    self._SelectNode(Fz_ev,Node,mu_k)
-                    continue
+                    # A flag for recursion on ambiguity
+                    AmbRed = False
                     
-                #amb = dict()
-                for Pa in new:
-                    # The variable under Analysis
-                    FV_P = theFuzzySet[Pa]
-                    try:
-                        amb = ClassAmbiguityWithP(fs_C, FV_P, mu)
-                    except(ZeroDivisionError):
-                        amb = 1.
-                        AmbRed = False
-                        continue
+                    # Intersections of the best attribute of this branch
+                    ins_split = None
                     
-                    if amb < curr_CA: 
-                        AmbRed = True
-                        if not("target") in locals():
-                            target = amb
-                            ins_node = Pa
-                        else:
-                            if amb < target:
+                    for Pa, amb, is_valid in zip(new, branch["ambs"],
+                                                 branch["valid"]):
+                        # Empty intersections with the variable: its 
+                        # ambiguity is not a number, so it is skipped
+                        if not is_valid:
+                            continue
+                        
+                        if amb < curr_CA: 
+                            AmbRed = True
+                            if (target is None) or (amb < target):
                                 target = amb
                                 ins_node = Pa
-
-                # If yes, select the attribute with smallest classification
-                # ambiguity as a new decision node from the branch.                            
-                if AmbRed:
-                    newN = Node.append(ins_node, mu_k)
-                    newN.Truth = target
-                    NodeList.append(newN)
-                    del target
+                                ins_split = branch["splits"].get(Pa)
+    
+                    # If yes, select the attribute with smallest 
+                    # classification ambiguity as a new decision node 
+                    # from the branch.                            
+                    if AmbRed:
+                        newN = Node.append(ins_node, mu_k)
+                        newN.Truth = target
+                        newN.Evidence = branch.get("mu")
+                        newN.Support = branch.get("rows")
+                        if ins_split is not None: 
+                            Splits[newN] = dict(
+                                (k, (m if m is None else m.copy(), ev))
+                                for k, (m, ev) in ins_split.items())
+                        NodeList.append(newN)
+                        target = None
+                            
+                    # If not, terminate this branch as a leaf. At the leaf,
+                    # all objects will be labelled to one class with the 
+                    # highest truth level.
+                    if not(AmbRed):
+                        if (amb == 1.) | (isnan(amb)): continue
+                        self._SelectNode(Fz_ev,Node,mu_k)
                         
-                # If not, terminate this branch as a leaf. At the leaf, all objects
-                # will be labelled to one class with the highest truth level.
-                if not(AmbRed):
-                    if (amb == 1.) | (isnan(amb)): continue
-                    Fz_ev = FuzzyEvidence2(fs_C, mu)
-                    self._SelectNode(Fz_ev,Node,mu_k)
+                # All the branches have their own evidence. It is no 
+                # longer needed
+                Node.Evidence = None
+                Node.Support = None
                     
         #print NodeList
         
+    def _NodeTask(self, Node, all_vars, split):
+        '''Information needed to evaluate the branches of a node:
+        (Name, Support, Evidence, split, new, curr_CA, path)'''
+        
+        # These are the FuzzyVars not included in the tree
+        new = (all_vars - Node.FVAncestors)
+        # We remove also current node
+        new = list(new - set([Node.Name]))
+        
+        # Terms of the attributes from the root to the node
+        path = [p.split(":") for p in Node.Ancestors]
+        
+        return (Node.Name, Node.Support, Node.Evidence, split, new, 
+                Node.Truth, path)
+        
+        
     def _SelectNode(self, Fz_ev, Node, mu_k):
         tr_lev = max(Fz_ev.values())
         for mu_c in Fz_ev.keys():
@@ -273,25 +308,274 @@ class FuzzyTree(object):
     def classify(self, theFuzzySet):
         '''Performs a classification according to the rules of the tree'''
         
-        # Creating the output
-        kNV = self._FuzzySet[self._RHS].keys() # Output memberships
-        dNV = dict()
-        length = len(theFuzzySet)
+        def column(attr, term):
+            return theFuzzySet[attr][term]._value
+        
+        return self._infer(column, len(theFuzzySet))
+        
+    def predict_membership(self, X, fuzzifications = None):
+        '''Classification of raw (not fuzzified) data. Only the terms used
+        by the tree are fuzzified, and they are fed straight to the 
+        inference without building a FuzzySet.
+        
+        Parameters
+        ============
+        - X : Raw values of the attributes. A DataFrame (or a dictionary of
+              arrays) with a column per attribute, or a 2D array with the 
+              attributes in the order of LHS. Single records (a pandas 
+              Series) go to predict_one_membership
+        - fuzzifications : Dictionary with the Fuzzification object of each
+              attribute. By default, the one given when building the tree
+        
+        Output
+        ============
+        A FuzzyVar with the membership to each class, as in classify
+        
+        Usage
+        ============
+        >>> ft = FuzzyTree(fs, Beta, Alpha, varRHS, varLHS, 
+                           fuzzifications = fnVars)
+        >>> memberships = ft.predict_membership(data)
+        '''
+        
+        if fuzzifications is None:
+            fuzzifications = self._Fuzzifications
+            
+        if fuzzifications is None:
+            raise Exception("No fuzzification functions for the attributes")
+        
+        # A single record (a 1D array or a pandas Series) is not a column 
+        # per attribute
+        if not hasattr(X, "keys"):
+            X = asarray(X)
+            if X.ndim != 2:
+                raise Exception("Single record: use predict_one_membership")
+            nRows = len(X)
+        elif getattr(X, "ndim", 2) != 2:
+            raise Exception("Single record: use predict_one_membership")
+        elif hasattr(X, "index"):
+            nRows = len(X.index)
+        else:
+            # The columns of a dictionary must have the same length
+            lengths = set(len(X[attr]) for attr in self._LHS if attr in X)
+            if len(lengths) > 1:
+                raise Exception("Sizes not compatible")
+            nRows = lengths.pop() if len(lengths) > 0 else 0
+            
+        # The terms used by the tree are fuzzified together for each 
+        # attribute (a crisp attribute is factorized once), and only once 
+        # even if the tree uses them in several branches
+        used = dict()
+        for d, attr, term, leaf in self._Plan:
+            if not(term in used.setdefault(attr, [])):
+                used[attr].append(term)
+                
+        memberships = dict()
+            
+        def column(attr, term):
+            if not((attr, term) in memberships):
+                if hasattr(X, "keys"):
+                    values = X[attr]
+                else:
+                    values = X[:, self._LHS.index(attr)]
+                terms = fuzzifications[attr].memberships(used[attr], values)
+                for t in terms.keys():
+                    memberships[(attr, t)] = terms[t]
+            return memberships[(attr, term)]
+            
+        return self._infer(column, nRows)
+        
+    def predict(self, X, fuzzifications = None):
+        '''Class of each row of raw (not fuzzified) data: the class with 
+        the highest membership according to predict_membership (the last 
+        one in case of ties, as in confussion_matrix)'''
+        
+        Result = self.predict_membership(X, fuzzifications)
+        terms = list(Result.keys())
         
-        for k in kNV:
-            dNV[k] = zeros([length])
+        return [terms[c] for c in self._last_argmax(Result.Matrix)]
+        
+    def predict_one_membership(self, record, fuzzifications = None):
+        '''Membership of a single raw (not fuzzified) record to each class.
+        It is a low latency path for the classification of objects one by
+        one: the rules of the tree are compiled once to integer indices and
+        only plain Python floats are used.
+        
+        Parameters
+        ============
+        - record : Raw values of the attributes of the object. A dictionary
+                   (or a pandas Series) by attribute, or a sequence in the 
+                   order of LHS
+        - fuzzifications : Dictionary with the Fuzzification object of each
+                   attribute. By default, the one given when building the 
+                   tree
+        
+        Output
+        ============
+        A FuzzyValue with the membership to each class
+        
+        Usage
+        ============
+        >>> ft.predict_one_membership({"Wind": 7.4, "Temp": 67, "Month": 5,
+                                       "Day": 1})
+        '''
+        
+        classes, out = self._predict_one(record, fuzzifications)
+        
+        return FuzzyValue(**dict(zip(classes, out)))
+        
+    def predict_one(self, record, fuzzifications = None):
+        '''Class of a single raw record: the class with the highest 
+        membership according to predict_one_membership (the last one in 
+        case of ties, as in predict)'''
+        
+        classes, out = self._predict_one(record, fuzzifications)
+        
+        maxim = max(out)
+        c = len(out) - 1 - out[::-1].index(maxim)
+        
+        return classes[c]
+        
+    def _predict_one(self, record, fuzzifications):
+        '''Inference of a single record. Returns the classes and the list
+        of memberships'''
+        
+        names, positions, functions, steps, classes, depth = \
+            self._compile_rules(fuzzifications)
+        
+        # Memberships of the terms used by the tree
+        if hasattr(record, "keys"):
+            mems = [f(record[a]) for a, f in zip(names, functions)]
+        else:
+            mems = [f(record[p]) for p, f in zip(positions, functions)]
+            
+        out = [0.] * len(classes)
+        activation = [0.] * depth
+        
+        for d, term, leaf in steps:
+            act = mems[term]
+            if d > 0:
+                parent = activation[d - 1]
+                if parent < act: act = parent
+                
+            if leaf < 0:
+                activation[d] = act
+            elif act > out[leaf]:
+                out[leaf] = act
+                
+        return (classes, out)
+        
+    def _compile_rules(self, fuzzifications):
+        '''Compiles the inference plan with integer indices for the 
+        prediction of single records. The result is kept while the 
+        Fuzzification objects of the attributes used by the tree are the 
+        same, so refitting an attribute in place (fnVars[attr] = ...) 
+        compiles the rules again.
+        
+        Output
+        ============
+        - names : Attribute of each term used by the tree
+        - positions : Position of the attribute of each term in LHS
+        - functions : Fuzzification function of each term
+        - steps : Plan of the tree as (depth, term index, class index). The 
+                  class index is -1 for the decision nodes
+        - classes : Names of the classes
+        - depth : Number of levels of the tree
+        '''
+        
+        if fuzzifications is None:
+            fuzzifications = self._Fuzzifications
+            
+        if fuzzifications is None:
+            raise Exception("No fuzzification functions for the attributes")
+            
+        if self._Rules is not None:
+            compiled, rules = self._Rules
+            for attr, fuzzification in compiled:
+                if fuzzifications[attr] is not fuzzification:
+                    break
+            else:
+                return rules
+        
+        classes = self._Classes
+        index = dict()
+        names = []
+        positions = []
+        functions = []
+        steps = []
+        depth = 0
+        
+        for d, attr, term, leaf in self._Plan:
+            if not((attr, term) in index):
+                index[(attr, term)] = len(names)
+                names.append(attr)
+                positions.append(self._LHS.index(attr))
+                functions.append(fuzzifications[attr][term])
+                
+            if leaf is None:
+                steps.append((d, index[(attr, term)], -1))
+            else:
+                steps.append((d, index[(attr, term)], classes.index(leaf)))
+                
+            depth = max(depth, d + 1)
+            
+        rules = (names, positions, functions, steps, classes, depth)
+        compiled = tuple((attr, fuzzifications[attr]) 
+                         for attr in sorted(set(names)))
+        self._Rules = (compiled, rules)
+        
+        return rules
+        
+    def _infer(self, column, length):
+        '''Inference of the tree. column(attribute, term) must provide the
+        membership of the data (length samples) to a term'''
+        
+        # Creating the output
+        kNV = self._Classes # Output memberships
         
         # This is the output variable
-        fNV = FuzzyVar(self._RHS,**dNV)
+        fNV = FuzzyVar.from_matrix(self._RHS, kNV,
+                                   zeros([length, len(kNV)], order="F"))
+        out = fNV.Matrix
         
         #..............................................................
-        # Now we go for the classification
-        for leaf in self._Leaves:
-            evidence = leaf.mu(theFuzzySet)
-            fNV[leaf.Name] = fNV[leaf.Name] | evidence
+        # Now we go for the classification, walking the tree top-down. The
+        # activation of each node is kept while its sons are visited
+        activation = dict()
+        
+        for depth, attr, term, leaf in self._Plan:
+            act = column(attr, term)
+            if depth > 0:
+                act = minimum(act, activation[depth - 1])
+                
+            if leaf is None:
+                activation[depth] = act
+            else:
+                col = out[:, fNV.index(leaf)]
+                maximum(col, act, out=col)
         
         return fNV
         
+    def _compile(self):
+        '''Inference plan of the tree: the nodes in depth-first order, as
+        tuples (depth, attribute, term, class). The class is None for the
+        decision nodes and the name of the class for the leaves'''
+        
+        plan = []
+        self._compile_Node(self.NodeParent, 0, plan)
+        
+        return plan
+        
+    def _compile_Node(self, Node, depth, plan):
+        '''Iteratively appends the sons of a node to the plan'''
+        
+        for child in Node._Sons:
+            if child.IsLeaf:
+                plan.append((depth, Node.Name, child._PMemb, child.Name))
+            else:
+                plan.append((depth, Node.Name, child._PMemb, None))
+                self._compile_Node(child, depth + 1, plan)
+        
     def confussion_matrix(self, RealClass, FuzzySet, print_matrix = True):
         '''Calculation of the confussion matrix of the classification'''
         
@@ -304,23 +588,18 @@ class FuzzyTree(object):
             for ec in Result.keys():
                 output[rc][ec] = 0.
         
-        for rc, ec in zip(RealClass, Result):
-            M_rc = 0.
-            M_ec = 0.
-            
-            for k in rc.keys():
-                if (rc[k] >= M_rc):
-                    M_rc = rc[k]
-                    k_rc = k
-                    
-                if (ec[k] >= M_ec):
-                    M_ec = ec[k]
-                    k_ec = k
-            
-            try:
-                output[k_rc][k_ec] += 1.0
-            except:
-                output[k_rc][k_ec] = 0.
+        # Real and estimated memberships, with the same order of terms
+        terms = list(RealClass.keys())
+        M_rc = column_stack([RealClass[k]._value for k in terms])
+        M_ec = column_stack([Result[k]._value for k in terms])
+        
+        # Every object counts as many times as its weight
+        W = FuzzySet.Weights
+        if W is None: W = [1.0] * len(FuzzySet)
+        
+        for rc, ec, w in zip(self._last_argmax(M_rc), self._last_argmax(M_ec),
+                             W):
+            output[terms[rc]][terms[ec]] += w
                 
                 
         # Printing the output
@@ -338,6 +617,14 @@ class FuzzyTree(object):
             if print_matrix: print(row)
                     
         return output
+        
+    def _last_argmax(self, M):
+        '''Column of the maximum of each row. In case of ties the last
+        column is selected'''
+        
+        M = where(isnan(M), -inf, M)
+        
+        return M.shape[1] - 1 - argmax(M[:, ::-1], axis=1)
 
     
     
@@ -352,6 +639,13 @@ class FuzzyTreeNode(object):
     - PMemb :    The name of the membership function
     - Leaf:     Is this node a Leaf?: True, False, None
     - Truthness: Level of true of the current node
+    
+    While the tree is being built, the attribute Evidence keeps the 
+    membership of the training set up to the node (the conjunction of the 
+    memberships of all the ancestors), only for the rows with a nonzero
+    membership. Those rows (indices in the training set) are kept in the
+    attribute Support. Both are None for the root node (all the rows) and
+    they are released once the node has been expanded.
 
     Author
     =======
@@ -369,6 +663,8 @@ class FuzzyTreeNode(object):
         self.IsLeaf = Leaf
         self._Truthness = Truthness
         self._Sons = []
+        self.Evidence = None
+        self.Support = None
         
         # Updating ancestors
         try:
@@ -484,4 +780,361 @@ class FuzzyTreeNode(object):
         
         
        
-        
\ No newline at end of file
+                
+        
+def _ExpandNode(theFuzzySet, C, task, Alfa, Beta, compact = False):
+    '''Evaluates all the branches of a node of the tree. 
+    
+    Parameters
+    ============
+    - theFuzzySet : The FuzzySet the tree is built on
+    - C           : Name of the clasification FuzzyVar
+    - task        : Node information, as given by FuzzyTree._NodeTask
+    - Alfa, Beta  : Parameters of the tree
+    - compact     : If True, the candidate intersections are not returned
+                    (only their FuzzyEvidence2) and only for the candidates
+                    that reduce the ambiguity of the node
+    
+    Output
+    ============
+    A list of pairs (term, branch). The branch is None for the empty branches
+    and otherwise a dictionary with its FuzzyEvidence2 (Fz_ev) and, if it 
+    is not a leaf, its evidence (mu), support (rows), the ambiguities of 
+    the candidate attributes (ambs, valid) and their intersections (splits)
+    '''
+    
+    Name, rows, evidence, split, new, curr_CA, path = task
+    
+    fs_C = theFuzzySet[C]
+    P = theFuzzySet[Name]
+    W = theFuzzySet.Weights
+    
+    # Only the rows of the support of the node are considered
+    if rows is not None:
+        P = P.take(rows)
+        
+    output = []
+    for mu_k in P.keys():
+        
+        # For each nonempty branch of the decision node, calculate the 
+        # truth level of classifying all objects within the branch
+        # into each class
+        
+        # Member function includes the branch: the evidence of the
+        # node (None at the root) and the membership partitition.
+        # It was already computed if the node was chosen as a split
+        mu, Fz_ev = split.get(mu_k, (None, None))
+        if mu is None:
+            mu = P[mu_k] & evidence
+            
+        # Support of the branch: rows with a nonzero membership
+        nz = mu._value > 0.
+        if rows is None:
+            sub_rows = nz.nonzero()[0]
+        else:
+            sub_rows = rows[nz]
+        mu = FuzzyMembership(mu._attribute, mu._mu, mu._value[nz])
+        
+        if (len(sub_rows) == 0) or (mu.max() < Alfa):
+            output.append((mu_k, None))
+            continue
+        
+        # The classification (and weights) on the support of the branch
+        fs_C_k = fs_C.take(sub_rows)
+        W_k = None if W is None else W[sub_rows]
+        
+        if Fz_ev is None:
+            Fz_ev = FuzzyEvidence2(fs_C_k, mu, W_k)
+            
+        tr_lev = max(Fz_ev.values())
+        
+        # Empty evidence (null weights): NaN possibilities
+        if isnan(tr_lev) or (tr_lev == 0):
+            output.append((mu_k, None))
+            continue
+        
+        branch = dict(Fz_ev = Fz_ev)
+        output.append((mu_k, branch))
+        
+        # A leaf, by truth level or because all variables are already 
+        # included
+        if (tr_lev > Beta) or (len(new) == 0):
+            continue
+            
+        # All the variables under analysis are scored at once
+        FV_Ps = [theFuzzySet[Pa].take(sub_rows) for Pa in new]
+        Pa_splits = dict()
+        ambs, valid = BatchClassAmbiguityWithP(fs_C_k, FV_Ps, mu, Pa_splits,
+                                               W_k)
+        
+        if compact:
+            for Pa, amb, is_valid in zip(new, ambs, valid):
+                if is_valid and (amb < curr_CA):
+                    Pa_splits[Pa] = dict((k, (None, ev)) for k, (m, ev) 
+                                         in Pa_splits[Pa].items())
+                else:
+                    Pa_splits.pop(Pa, None)
+        
+        branch.update(mu = mu, rows = sub_rows, ambs = ambs, valid = valid,
+                      splits = Pa_splits)
+        
+    return output
+    
+def _RootAmbiguities(theFuzzySet, C, LHS):
+    '''Classification ambiguity of each attribute: NaN with empty terms, 1 if
+    it can not be computed'''
+    
+    fs_C = theFuzzySet[C]
+    
+    output = []
+    for P in LHS:
+        try:
+            FSamb = ClassAmbiguity(fs_C, theFuzzySet[P], theFuzzySet.Weights)
+        except:
+            FSamb = 1.
+        output.append(FSamb)
+        
+    return output
+    
+class _SerialExpander(object):
+    '''Expansion of the nodes of a FuzzyTree in the current process'''
+    
+    def __init__(self, theFuzzySet, C, Alfa, Beta):
+        self._FuzzySet = theFuzzySet
+        self._args = (C, Alfa, Beta)
+        
+    def root(self, LHS):
+        '''Classification ambiguity of the candidates to root node'''
+        return _RootAmbiguities(self._FuzzySet, self._args[0], LHS)
+        
+    def map(self, tasks):
+        '''Expands the nodes, the results come in the order of the tasks'''
+        C, Alfa, Beta = self._args
+        return (_ExpandNode(self._FuzzySet, C, task, Alfa, Beta) 
+                for task in tasks)
+        
+    def close(self):
+        pass
+    
+# Data of the worker processes of a _FrontierPool
+_WORKER = dict()
+
+def _InitWorker(block, layout, sparse, weights, C, Alfa, Beta):
+    '''Initialization of a worker process: the FuzzySet on the memory 
+    mapped block'''
+    
+    _WORKER["FuzzySet"] = FuzzySet.from_block(block, layout, sparse)
+    _WORKER["FuzzySet"].Weights = weights
+    _WORKER["args"] = (C, Alfa, Beta)
+    
+def _WorkerExpandNode(task):
+    C, Alfa, Beta = _WORKER["args"]
+    return _ExpandNode(_WORKER["FuzzySet"], C, task, Alfa, Beta, True)
+    
+class _FrontierPool(object):
+    '''Pool of worker processes to expand the nodes of a FuzzyTree. 
+    
+    The block of memberships of the FuzzySet is shared by the workers
+    through a memory mapped file (see _SharedPool). A FuzzySet loaded memory
+    mapped (FuzzySet.load) is mapped from its own file.
+    '''
+    
+    def __init__(self, theFuzzySet, C, Alfa, Beta, n_jobs):
+        self._FuzzySet = theFuzzySet
+        self._C = C
+        
+        block = theFuzzySet._file
+        if block is None:
+            block = theFuzzySet.Matrix
+        
+        self._pool = _SharedPool(n_jobs, _InitWorker, [block], 
+                                 (theFuzzySet.layout(), 
+                                  theFuzzySet._sparse_vars(), 
+                                  theFuzzySet.Weights, C, Alfa, Beta))
+        
+    def root(self, LHS):
+        '''Classification ambiguity of the candidates to root node'''
+        return _RootAmbiguities(self._FuzzySet, self._C, LHS)
+        
+    def map(self, tasks):
+        '''Expands the nodes, the results come in the order of the tasks'''
+        return self._pool.map(_WorkerExpandNode, tasks)
+        
+    def close(self):
+        self._pool.close()
+        
+        
+def _ChunkStats(theFuzzySet, C, jobs):
+    '''Sufficient statistics of a chunk of data for a list of jobs. 
+    
+    A job (None, LHS, None) gives the sigma counts of the terms of the 
+    attributes LHS (sums) and of their intersections with the classes 
+    (inter). A job (path, Name, new) gives, for each term of the attribute
+    Name, the statistics of the branch whose evidence is the intersection 
+    of the terms in path: its maximum (max), number of objects (nnz), sigma
+    count (sA), sigma count of its intersection with each class (sC) and 
+    the sums and inter of the candidate attributes new within the branch.
+    '''
+    
+    fs_C = theFuzzySet[C].Matrix
+    W = theFuzzySet.Weights
+    
+    def column(attr, term):
+        return theFuzzySet[attr][term]._value
+    
+    output = []
+    for path, Name, new in jobs:
+        
+        if path is None:
+            M = column_stack([theFuzzySet[P].Matrix for P in Name])
+            output.append(dict(sums = sigma_counts(M, W), 
+                               inter = intersection_sums(M, fs_C, 
+                                                         weights = W)))
+            continue
+            
+        evidence = None
+        for attr, term in path:
+            col = column(attr, term)
+            evidence = col if evidence is None else minimum(evidence, col)
+            
+        stats = []
+        for mu_k in theFuzzySet[Name].keys():
+            mu = column(Name, mu_k)
+            if evidence is not None:
+                mu = minimum(mu, evidence)
+                
+            # Only the objects in the support of the branch
+            nz = mu > 0.
+            mu = mu[nz]
+            fs_C_k = fs_C[nz]
+            W_k = None if W is None else W[nz]
+            
+            st = dict(max = mu.max() if len(mu) > 0 else 0., 
+                      nnz = len(mu), sA = sigma_counts(mu[:, newaxis], W_k)[0], 
+                      sC = intersection_sums(mu, fs_C_k, weights = W_k)[0])
+            
+            if len(new) > 0:
+                M = column_stack([theFuzzySet[Pa].Matrix[nz] for Pa in new])
+                InSe = minimum(M, quantize(mu, M.dtype)[:, newaxis])
+                st.update(sums = sigma_counts(InSe, W_k), 
+                          inter = intersection_sums(InSe, fs_C_k, 
+                                                    weights = W_k))
+            stats.append(st)
+            
+        output.append(stats)
+        
+    return output
+    
+def _MergeStats(A, B):
+    '''Merges the statistics of two parts of the data'''
+    
+    if isinstance(A, list):
+        return [_MergeStats(a, b) for a, b in zip(A, B)]
+        
+    return dict((k, maximum(A[k], B[k]) if k == "max" else A[k] + B[k]) 
+                for k in A.keys())
+    
+def _ShardStats(shard, C, jobs):
+    '''Sufficient statistics of all the chunks of a shard'''
+    
+    output = None
+    for chunk in FuzzyChunks(shard):
+        stats = _ChunkStats(chunk, C, jobs)
+        output = stats if output is None else _MergeStats(output, stats)
+        
+    return output
+    
+class _ChunkedExpander(object):
+    '''Expansion of the nodes of a FuzzyTree built on a FuzzyChunks.
+    
+    Each frontier of the tree takes a single pass over the data, in which 
+    the sufficient statistics of all its branches are accumulated chunk 
+    by chunk. The shards are processed in n_jobs worker processes and 
+    their statistics are merged. The tree is the same as in memory, up to 
+    the rounding of the sums.
+    '''
+    
+    def __init__(self, theChunks, C, Alfa, Beta, n_jobs):
+        self._Chunks = theChunks
+        self._C = C
+        self._Alfa = Alfa
+        self._Beta = Beta
+        
+        self._layout = dict(theChunks.layout())
+        
+        if n_jobs > 1:
+            self._executor = ProcessPoolExecutor(max_workers = n_jobs)
+        else:
+            self._executor = None
+        
+    def _stats(self, jobs):
+        '''Statistics of the jobs on the whole data'''
+        
+        shards = self._Chunks.Shards
+        if self._executor is None:
+            parts = (_ShardStats(shard, self._C, jobs) for shard in shards)
+        else:
+            n = len(shards)
+            parts = self._executor.map(_ShardStats, shards, [self._C] * n,
+                                       [jobs] * n)
+            
+        output = None
+        for part in parts:
+            output = part if output is None else _MergeStats(output, part)
+            
+        return output
+        
+    def root(self, LHS):
+        '''Classification ambiguity of the candidates to root node'''
+        
+        stats = self._stats([(None, list(LHS), None)])[0]
+        sizes = [len(self._layout[P]) for P in LHS]
+        ambs, valid = ClassAmbiguityFromStats(sizes, stats["sums"], 
+                                              stats["inter"])
+        
+        return list(where(valid, ambs, float("nan")))
+        
+    def map(self, tasks):
+        '''Expands the nodes, the results come in the order of the tasks'''
+        
+        jobs = [(path, Name, new) for Name, rows, evidence, split, new, 
+                curr_CA, path in tasks]
+        classes = self._layout[self._C]
+        
+        output = []
+        for (path, Name, new), stats in zip(jobs, self._stats(jobs)):
+            sizes = [len(self._layout[Pa]) for Pa in new]
+            
+            branches = []
+            for mu_k, st in zip(self._layout[Name], stats):
+                
+                if (st["nnz"] == 0) or (st["max"] < self._Alfa) or \
+                   (st["sA"] == 0):
+                    branches.append((mu_k, None))
+                    continue
+                
+                Fz_ev = FuzzyValue(**dict(zip(classes, st["sC"] / st["sA"])))
+                tr_lev = max(Fz_ev.values())
+                
+                if tr_lev == 0:
+                    branches.append((mu_k, None))
+                    continue
+                
+                branch = dict(Fz_ev = Fz_ev)
+                branches.append((mu_k, branch))
+                
+                # A leaf
+                if (tr_lev > self._Beta) or (len(new) == 0):
+                    continue
+                
+                ambs, valid = ClassAmbiguityFromStats(sizes, st["sums"], 
+                                                      st["inter"])
+                branch.update(ambs = ambs, valid = valid, splits = dict())
+                
+            output.append(branches)
+            
+        return output
+        
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
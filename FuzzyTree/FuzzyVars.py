@@ -5,8 +5,15 @@ Created on Tue Jun 10 17:48:54 2014
 @author: JMBELDA
 """
 
-from numpy import mean, log, iterable
+from numpy import mean, log, iterable, asarray, where, errstate, \
+    ascontiguousarray, minimum, maximum, asfortranarray, column_stack, \
+    vstack, hstack, zeros, sort, arange, newaxis, empty, ones, isnan, inf, \
+    save, load, dtype, iinfo, rint, clip, float64, float32, uint8, uint16, \
+    int64, bincount, searchsorted, concatenate, argsort, diff, flatnonzero, \
+    dot, unique, average, void
 from pylab import plot, show, axis, legend
+import json
+import os
 
 def pLog(value):
     '''Helper function: Log of value if it is positive definite
@@ -26,6 +33,7 @@ def cFF(function, *args):
         
     # Adding the information
     in_f.args = args
+    in_f.function = function
     return in_f
 
 def lff(x,m1,m2):
@@ -57,6 +65,29 @@ def cff(x,m1,m2,m3):
     elif (x >= m3):
         return (0.)
 
+def lff_array(x,m1,m2):
+    '''Left Fuzzyfication function over an array of values'''
+    x = asarray(x, dtype=float)
+    with errstate(divide="ignore", invalid="ignore"):
+        return where(x < m1, 1., where(x > m2, 0., (m2 - x)/(m2 - m1)))
+
+def rff_array(x,m1,m2):
+    '''Right Fuzzyfication function over an array of values'''
+    x = asarray(x, dtype=float)
+    with errstate(divide="ignore", invalid="ignore"):
+        return where(x < m1, 0., where(x > m2, 1., (x - m1)/(m2 - m1)))
+
+def cff_array(x,m1,m2,m3):
+    '''Center Fuzzyfication function over an array of values'''
+    x = asarray(x, dtype=float)
+    with errstate(divide="ignore", invalid="ignore"):
+        return where(x < m1, 0.,
+                     where(x < m2, (x - m1)/(m2 - m1),
+                           where(x < m3, (m3 - x)/(m3 - m2), 0.)))
+
+# Array counterparts of the scalar fuzzyfication functions
+ARRAY_FF = {lff: lff_array, rff: rff_array, cff: cff_array}
+
 
 class Fuzzification(object):
     '''Class to fuzzyfy to a given Fuzzy Value
@@ -74,16 +105,11 @@ class Fuzzification(object):
         
     def __call__(self, value):
         if iterable(value) & (type(value) != str):
-            # Inicialising variables
+            values = asarray(value)
             output = dict()
             
-            temp = dict()
             for k in self._values.keys():
-                output[k] = []
-                
-            for v in value:
-                for k in self._values.keys():
-                    output[k].append(self._values[k](v))
+                output[k] = self._fuzzify_array(self._values[k], values)
                     
             return FuzzyVar(self._varName, **output)
             
@@ -94,6 +120,39 @@ class Fuzzification(object):
             
             return FuzzyValue(**output)
             
+    def _fuzzify_array(self, function, values):
+        '''Fuzzifies a whole array of values with a single term function.
+        Closures built with cFF over lff, rff or cff run as array operations,
+        any other function is called value by value.'''
+        
+        array_f = ARRAY_FF.get(getattr(function, "function", None))
+        
+        if (array_f is not None) and (values.dtype.kind in "biuf"):
+            return array_f(values, *function.args)
+        
+        return asarray([function(v) for v in values], dtype=float)
+        
+    def membership(self, term, values):
+        '''Membership of an array of values to a single linguistic term'''
+        return self._fuzzify_array(self._values[term], asarray(values))
+        
+    def memberships(self, terms, values):
+        '''Membership of an array of values to several linguistic terms, as 
+        a dictionary by term'''
+        
+        values = asarray(values)
+        
+        return dict((t, self._fuzzify_array(self._values[t], values)) 
+                    for t in terms)
+        
+    def keys(self):
+        '''Linguistic terms of the fuzzification'''
+        return self._values.keys()
+        
+    def __getitem__(self, term):
+        '''Fuzzification function of a linguistic term'''
+        return self._values[term]
+            
     def do_plot(self, values):
         var = self(values)
         
@@ -182,6 +241,7 @@ class FuzzyValue(object):
         # Normalize the values of the variable to the maximum
         vals = self.values()
         max_val = max(vals)       
+        if max_val == 0.: return 0.
         vals = [float(v)/max_val for v in vals]
         
         # Addding a zero
@@ -202,6 +262,13 @@ class FuzzyValue(object):
 class FuzzyVar(object):
     '''A Fuzzy Variable consisting on a set of Fuzzy Values
     
+    The memberships are stored as a single (n_samples x n_terms) matrix in
+    column-major order, so that every linguistic term is a contiguous column
+    that can be handed out as a FuzzyMembership without copying.
+    
+    The matrix is float64 by default. A more compact storage type can be
+    chosen with astype (see quantize).
+    
     Author
     =======
     Juanma Belda: jmbeldalois@gmail.com
@@ -210,72 +277,120 @@ class FuzzyVar(object):
     '''
     
     def __init__(self, attr, **kargs):
-        self._values = kargs
         self._attribute = attr
+        self._index = dict()
+        
+        columns = []
+        for c, k in enumerate(kargs.keys()):
+            self._index[k] = c
+            columns.append(asarray(kargs[k], dtype=float).ravel())
+            
+        if len(set(len(col) for col in columns)) > 1:
+            raise Exception("Sizes not compatible")
+            
+        if len(columns) > 0:
+            self._matrix = asfortranarray(column_stack(columns))
+        else:
+            self._matrix = zeros((0, 0), order="F")
         
         # This is the counter for the iterator
         self._current = 0
         
-    def __getitem__(self, name):
-        return FuzzyMembership(self._attribute, name, self._values[name])
+    @classmethod
+    def from_matrix(cls, attr, terms, matrix):
+        '''Creates a FuzzyVar on top of an existing (n_samples x n_terms) 
+        matrix. The matrix is used as is, without copying it.'''
+        
+        output = cls(attr)
+        output._set_matrix(terms, matrix)
+        
+        return output
+        
+    def _set_matrix(self, terms, matrix):
+        '''Rebinds the storage of the variable to a given matrix'''
+        
+        if matrix.shape[1] != len(terms):
+            raise Exception("Sizes not compatible")
+            
+        self._index = dict((k, c) for c, k in enumerate(terms))
+        self._matrix = matrix
         
+    def __getitem__(self, name):
+        return FuzzyMembership(self._attribute, name, 
+                               self._matrix[:, self._index[name]])
         
     def __setitem__(self, name, value):
-        if len(self._values[name] == len(value)):
-            for c in range(len(value)):
-                self._values[name][c] = value[c]
+        if len(self) == len(value):
+            self._matrix[:, self._index[name]] = quantize(value, 
+                                                          self._matrix.dtype)
         else:
-            raise("Sizes not compatible")
+            raise Exception("Sizes not compatible")
             
     def _getname(self):
         return self._attribute
         
     Name = property(_getname)
+    
+    def _getmatrix(self):
+        return self._matrix
+        
+    Matrix = property(_getmatrix, doc="Matrix of memberships (samples x terms)")
+        
+    def index(self, name):
+        '''Column of the matrix holding a given linguistic term'''
+        return self._index[name]
+        
+    def take(self, rows):
+        '''Returns a new FuzzyVar with only the given rows (samples)'''
+        return FuzzyVar.from_matrix(self._attribute, list(self.keys()),
+                                    asfortranarray(self._matrix[rows]))
+        
+    def astype(self, dtype):
+        '''Returns a copy of the variable with the memberships stored in 
+        another type (see quantize)'''
+        return FuzzyVar.from_matrix(self._attribute, list(self.keys()),
+                                    asfortranarray(quantize(self._matrix, 
+                                                            dtype)))
+        
+    def tosparse(self):
+        '''Returns a copy of the variable as a SparseFuzzyVar'''
+        return SparseFuzzyVar.from_matrix(self._attribute, list(self.keys()),
+                                          self._matrix)
         
     def append(self, **kargs):
-        for k in kargs:
-            self._values[k].append(kargs[k])
+        row = quantize([[kargs[k] for k in self.keys()]], self._matrix.dtype)
+        self._matrix = asfortranarray(vstack([self._matrix, row]))
             
     def __repr__(self):
         cad = self._attribute + "\n"
-        val = list()
         
         # Creating the header
-        for k in self._values.keys():
-            cad  += k + "\t"
-            val.append(self._values[k])
-            
-        cad = cad[0:-1] + "\n"
+        cad += "\t".join(self.keys()) + "\n"
         
         # Creating the values
-        for vs in zip(*val):
-            for v in vs:
-                cad += str(v) + "\t"
-            
-            cad = cad[0:-1] + "\n"
+        for vs in dequantize(self._matrix):
+            cad += "\t".join(str(v) for v in vs) + "\n"
             
         return cad
         
     def __eq__(self, member):
-        return FuzzyMembership(self._attribute, member, self._values[member])
+        return self[member]
         
     def value(self,index):
-        a = dict()
-        for k in self.keys():
-            a[k] = self._values[k][index]
-            
-        return FuzzyValue(**a)
+        return FuzzyValue(**dict(zip(self.keys(), 
+                                     dequantize(self._matrix[index]))))
         
     def __iter__(self):
-        return self
+        for c in range(len(self)):
+            yield self.value(c)
         
     def __len__(self):
-        return len(self._values.values()[0])
+        return self._matrix.shape[0]
         
     def __next__(self):
         try:
             output = self.value(self._current)
-        except:
+        except IndexError:
             self._current = 0
             raise StopIteration
             
@@ -285,11 +400,12 @@ class FuzzyVar(object):
         
         
     def keys(self):
-        return self._values.keys()
+        return self._index.keys()
         
     def values(self):
-        return self._values.values()
+        return [dequantize(self._matrix[:, c]) for c in self._index.values()]
         
+
     def ambiguity(self):
         '''Calculation of the ambiguity associated to an attribute
         Ambiguity or nonspecificity measure: Let n = (n(x)lxeX) de note a 
@@ -314,11 +430,256 @@ class FuzzyVar(object):
         IBV - Valencia (July 2014)   
         '''
         
-        ambs = [f.ambiguity() for f in self]
+        ambs = row_ambiguity(self._matrix)
         
         return mean(ambs)
        
 
+class SparseFuzzyVar(object):
+    '''A Fuzzy Variable whose objects belong to a few of its terms only, as
+    with points_partition and percentile_partition (at most two adjacent 
+    terms) or crisp_partition (a single term).
+    
+    Each object keeps a fixed number (the width) of pairs (term, 
+    membership), stored as two (n_samples x width) matrices: the column of
+    the term and its membership. The unused pairs have membership 0. The 
+    memory and the cost of the kernels (AND, OR and the sigma counts of 
+    sparse_intersection_sums) depend on the width instead of the number of
+    terms.
+    
+    It has the interface of a FuzzyVar, so it can be part of a FuzzySet 
+    (out of its block) and a FuzzyTree can be built on it. The dense Matrix
+    is only built on demand.
+    
+    Usage
+    ==========
+    >>> fn, fv = percentile_partition(data["Temp"], "Temp", levels)
+    >>> sv = fv.tosparse()      # or SparseFuzzyVar.from_matrix
+    >>> fs = FuzzySet(sv, ...)
+    '''
+    
+    def __init__(self, attr, terms, columns, weights):
+        columns = asarray(columns)
+        weights = asarray(weights)
+        
+        if (columns.ndim != 2) or (columns.shape != weights.shape):
+            raise Exception("Sizes not compatible")
+            
+        self._attribute = attr
+        self._index = dict((k, c) for c, k in enumerate(terms))
+        self._columns = columns
+        self._weights = weights
+        
+    @classmethod
+    def from_matrix(cls, attr, terms, matrix):
+        '''Creates a sparse variable from a (n_samples x n_terms) matrix'''
+        
+        matrix = asarray(matrix)
+        rows, cols = (matrix != 0).nonzero()
+        
+        return cls._from_pairs(attr, terms, matrix.shape[0], rows, cols,
+                               matrix[rows, cols])
+        
+    @classmethod
+    def _from_pairs(cls, attr, terms, nRows, rows, cols, weights):
+        '''Creates a sparse variable from its nonzero memberships, given as
+        (row, column, membership) sorted by row'''
+        
+        # Position of every pair within its row
+        slot = arange(len(rows)) - searchsorted(rows, rows)
+        width = slot.max() + 1 if len(slot) > 0 else 1
+        
+        nTerms = len(terms)
+        if nTerms <= 256:
+            ctype = uint8
+        elif nTerms <= 65536:
+            ctype = uint16
+        else:
+            ctype = int64
+        
+        columns = zeros((nRows, width), dtype=ctype)
+        columns[rows, slot] = cols
+        values = zeros((nRows, width), dtype=asarray(weights).dtype)
+        values[rows, slot] = weights
+        
+        return cls(attr, terms, columns, values)
+        
+    def __getitem__(self, name):
+        c = self._index[name]
+        values = where(self._columns == c, self._weights, 0).max(axis=1)
+        return FuzzyMembership(self._attribute, name, values)
+        
+    def __setitem__(self, name, value):
+        if len(self) != len(value):
+            raise Exception("Sizes not compatible")
+            
+        matrix = self.Matrix
+        matrix[:, self._index[name]] = quantize(value, matrix.dtype)
+        other = SparseFuzzyVar.from_matrix(self._attribute, 
+                                           list(self.keys()), matrix)
+        self._columns = other._columns
+        self._weights = other._weights
+            
+    def _getname(self):
+        return self._attribute
+        
+    Name = property(_getname)
+    
+    def _getmatrix(self):
+        nRows, width = self._columns.shape
+        output = zeros((nRows, len(self._index)), dtype=self._weights.dtype,
+                       order="F")
+        
+        nz = self._weights != 0
+        rows = arange(nRows).repeat(width).reshape(nRows, width)
+        output[rows[nz], self._columns[nz]] = self._weights[nz]
+        
+        return output
+        
+    Matrix = property(_getmatrix, 
+                      doc="Dense matrix of memberships (samples x terms)")
+    
+    def _getwidth(self):
+        return self._columns.shape[1]
+        
+    Width = property(_getwidth, doc="Number of pairs stored per object")
+        
+    def index(self, name):
+        '''Column of the dense matrix holding a given linguistic term'''
+        return self._index[name]
+        
+    def take(self, rows):
+        '''Returns a new SparseFuzzyVar with only the given rows (samples)'''
+        return SparseFuzzyVar(self._attribute, list(self.keys()),
+                              self._columns[rows], self._weights[rows])
+        
+    def astype(self, dtype):
+        '''Returns a copy of the variable with the memberships stored in 
+        another type (see quantize)'''
+        return SparseFuzzyVar(self._attribute, list(self.keys()),
+                              self._columns, quantize(self._weights, dtype))
+        
+    def todense(self):
+        '''Returns a copy of the variable as a FuzzyVar'''
+        return FuzzyVar.from_matrix(self._attribute, list(self.keys()), 
+                                    self.Matrix)
+        
+    def append(self, **kargs):
+        row = quantize([[kargs[k] for k in self.keys()]], self._weights.dtype)
+        row = SparseFuzzyVar.from_matrix(self._attribute, list(self.keys()), 
+                                         row)
+        
+        width = max(self.Width, row.Width)
+        columns, weights = [], []
+        for v in [self, row]:
+            pad = zeros((len(v), width - v.Width), dtype=v._columns.dtype)
+            columns.append(hstack([v._columns, pad]))
+            weights.append(hstack([v._weights, pad.astype(v._weights.dtype)]))
+            
+        self._columns = vstack(columns)
+        self._weights = vstack(weights)
+        
+    def _combine(self, other, union):
+        '''Elementwise OR (union) or AND of two sparse variables with the
+        same terms, visiting only the stored pairs'''
+        
+        if (type(other) != SparseFuzzyVar) or \
+           (list(other.keys()) != list(self.keys())) or \
+           (len(other) != len(self)):
+            raise Exception("Sizes not compatible")
+            
+        nRows, nTerms = len(self), len(self._index)
+        
+        A, B = self._weights, other._weights
+        if A.dtype != B.dtype:
+            A, B = dequantize(A), dequantize(B)
+        
+        # Nonzero pairs of both variables, sorted by (row, term)
+        rows = concatenate([arange(nRows).repeat(v.Width) 
+                            for v in [self, other]])
+        keys = rows * nTerms + concatenate([self._columns.ravel(), 
+                                            other._columns.ravel()])
+        weights = concatenate([A.ravel(), B.ravel()])
+        
+        nz = weights != 0
+        keys, weights = keys[nz], weights[nz]
+        order = argsort(keys, kind="stable")
+        keys, weights = keys[order], weights[order]
+        
+        first = flatnonzero(concatenate([[True], diff(keys) != 0]))
+        if union:
+            weights = maximum.reduceat(weights, first) if len(first) else weights
+        else:
+            # Only the pairs present in both variables
+            both = diff(concatenate([first, [len(keys)]])) == 2
+            weights = minimum.reduceat(weights, first)[both] if len(first) \
+                      else weights
+            first = first[both]
+        keys = keys[first]
+        
+        return SparseFuzzyVar._from_pairs(self._attribute, list(self.keys()),
+                                          nRows, keys // nTerms, 
+                                          keys % nTerms, weights)
+        
+    def __and__(self, other):
+        '''Intersection of every term with a FuzzyMembership (an evidence),
+        or elementwise with another SparseFuzzyVar'''
+        
+        if type(other) == FuzzyMembership:
+            mu = quantize(other._value, self._weights.dtype)
+            return SparseFuzzyVar(self._attribute, list(self.keys()),
+                                  self._columns, 
+                                  minimum(self._weights, mu[:, newaxis]))
+            
+        return self._combine(other, False)
+        
+    def __or__(self, other):
+        '''Elementwise union with another SparseFuzzyVar'''
+        return self._combine(other, True)
+            
+    def __repr__(self):
+        return self.todense().__repr__()
+        
+    def __eq__(self, member):
+        return self[member]
+        
+    def value(self, index):
+        return FuzzyValue(**dict(zip(self.keys(), 
+                                     dequantize(self.take([index]).Matrix[0]))))
+        
+    def __iter__(self):
+        for c in range(len(self)):
+            yield self.value(c)
+        
+    def __len__(self):
+        return self._columns.shape[0]
+        
+    def keys(self):
+        return self._index.keys()
+        
+    def values(self):
+        return [self[k]._value for k in self.keys()]
+        
+    def ambiguity(self):
+        '''Calculation of the ambiguity associated to an attribute, as in
+        FuzzyVar.ambiguity'''
+        
+        return mean(row_ambiguity(self.Matrix))
+        
+
+def _and_label(A, B):
+    '''Attribute and member name of the conjunction of two memberships,
+    given as pairs (attribute, member name)'''
+    
+    if B[0] == A[0]:
+        attr = A[0]
+        mu = "%s & %s" % (A[1], B[1])
+    else:
+        attr = "?"
+        mu = "%s(%s) & %s(%s)" % (A[0], A[1], B[0], B[1])
+        
+    return (attr, mu)
+
 
 class FuzzyMembership(object):
     '''Representation of the values of the members of a Fuzzy set
@@ -333,7 +694,7 @@ class FuzzyMembership(object):
     def __init__(self, Attr, Member, Values):
         self._attribute = Attr
         self._mu = Member
-        self._value = Values
+        self._value = ascontiguousarray(dequantize(Values))
         
         
     def __and__(self, other):
@@ -341,17 +702,10 @@ class FuzzyMembership(object):
         if other == None:
             return self
 
-        if other._attribute == self._attribute:
-            attr = self._attribute
-            mu = "%s & %s" % (self._mu, other._mu)
-        else:
-            attr = "?"
-            mu = "%s(%s) & %s(%s)" % (self._attribute, self._mu, other._attribute, other._mu)
+        attr, mu = _and_label((self._attribute, self._mu), 
+                              (other._attribute, other._mu))
         
-        vals = [] # Output values
-        
-        for m,y in zip(self._value, other._value):
-            vals.append(min(m,y))
+        vals = minimum(self._value, other._value) # Output values
             
         return FuzzyMembership(attr,mu,vals)
 
@@ -363,10 +717,7 @@ class FuzzyMembership(object):
             attr = "?"
             mu = "%s(%s) or %s(%s)" % (self._attribute, self._mu, other._attribute, other._mu)
         
-        vals = [] # Output values
-        
-        for m,y in zip(self._value, other._value):
-            vals.append(max(m,y))
+        vals = maximum(self._value, other._value) # Output values
             
         return FuzzyMembership(attr,mu,vals)
         
@@ -374,9 +725,9 @@ class FuzzyMembership(object):
         '''Fuzzy not'''
         attr = self._attribute
         mu = "not(" + self._mu + ")"
-        vals = [1. - v for v in self._value]
+        vals = 1. - self._value
         
-        return FuzzyMembership(attr,mu,list(vals))
+        return FuzzyMembership(attr,mu,vals)
         
     def __le__(self, other):
         '''Assessment of subset'''
@@ -395,6 +746,25 @@ class FuzzyMembership(object):
     def __len__(self):
         return len(self._value)
         
+    def __iter__(self):
+        return iter(self._value)
+        
+    def __array__(self, dtype=None, copy=None):
+        return asarray(self._value, dtype=dtype)
+        
+    def copy(self):
+        '''Returns a copy of the membership, with its own values'''
+        return FuzzyMembership(self._attribute, self._mu, self._value.copy())
+        
+    def sum(self):
+        '''Sigma count (cardinality) of the membership, accumulated in 
+        float64 whatever the storage type'''
+        return self._value.sum(dtype=float64)
+        
+    def max(self):
+        '''Maximum membership value'''
+        return self._value.max()
+        
     def vagueness(self):
         '''Vagueness of a linguistical term.  Definition 4 in 
         Yuan et al. (1995)                
@@ -414,9 +784,12 @@ class FuzzyMembership(object):
         IBV - Valencia (July 2014)   
         '''
         
-        rel_val = [v*pLog(v) + (1- v) * pLog(1 - v) for v in self._value]
+        v = self._value
+        with errstate(divide="ignore", invalid="ignore"):
+            rel_val = where(v > 0., v*log(v), 0.) + \
+                      where(1. - v > 0., (1. - v)*log(1. - v), 0.)
                         
-        return -mean(rel_val)        
+        return -mean(rel_val, dtype=float64)
         
     def __getitem__(self, index):
         return self._value[index]
@@ -430,6 +803,15 @@ class FuzzySet(object):
     '''Representation of a number of Fuzzy observations with the sames
     attributes
     
+    All the memberships are kept in one contiguous column-major block
+    (n_samples x total number of terms). Each FuzzyVar of the set is a view
+    on its own range of columns of the block. The block can be stored in a
+    more compact type with astype (see quantize).
+    
+    The objects can have weights (Weights), which stand for the number of 
+    times each object is repeated. compress collapses the identical objects 
+    of a set into weighted ones.
+    
     Author
     =======
     Juanma Belda: jmbeldalois@gmail.com
@@ -441,9 +823,18 @@ class FuzzySet(object):
         '''Creates a Fuzzy set, and eventually set the attributes'''
 
         self._vals = dict()
+        self._weights = None
         
+        # The set keeps its own variables (views on its block), the 
+        # arguments are not modified
         for a in args:
-            self._vals[a.Name] = a
+            if type(a) == SparseFuzzyVar:
+                self._vals[a.Name] = SparseFuzzyVar(
+                    a.Name, list(a.keys()), a._columns.copy(), 
+                    a._weights.copy())
+            else:
+                self._vals[a.Name] = FuzzyVar.from_matrix(
+                    a.Name, list(a.keys()), a.Matrix)
         
         for k in kargs:
             member = dict()
@@ -451,15 +842,285 @@ class FuzzySet(object):
                 member[m] = []
                 
             self._vals[k] = FuzzyVar(k, **member)
-
+            
+        self._build_block([self._vals[k].Matrix for k in self._dense_keys()])
+        
+    def _dense_keys(self):
+        '''Attributes stored in the block (all but the sparse ones)'''
+        return [k for k in self._vals.keys() 
+                if type(self._vals[k]) != SparseFuzzyVar]
+        
+    def _getweights(self):
+        return self._weights
+        
+    def _setweights(self, weights):
+        if weights is not None:
+            weights = asarray(weights, dtype=float)
+            if weights.shape != (len(self),):
+                raise Exception("Sizes not compatible")
+        self._weights = weights
+        
+    Weights = property(_getweights, _setweights, 
+                       doc="Weights of the objects (None for all equal to 1)")
+        
+    def compress(self, return_inverse = False):
+        '''Returns a set with the identical objects collapsed into one, 
+        weighted by their number (or by the sum of their weights). The 
+        objects keep the order of their first occurrence.
+        
+        A FuzzyTree built on the compressed set is the same as on the whole
+        set (up to the rounding of the sums), at the cost of the distinct 
+        objects only. This pays off with few terms and crisp or low 
+        cardinality attributes.
+        
+        Parameters
+        ==========
+        
+        - return_inverse : If True, it also returns the object of the 
+                           compressed set of every original object
+                           
+        Usage
+        ==========
+        >>> fsc = fs.compress()
+        >>> ft = FuzzyTree(fsc, Beta, Alpha, varRHS, varLHS)
+        '''
+        
+        sparse = self._sparse_vars()
+        M = ascontiguousarray(hstack([self._block] + 
+                                     [v.Matrix for v in sparse.values()]))
+        
+        # Every object as a single opaque value, so the rows are compared
+        # as a whole
+        rows = M.view(dtype((void, M.dtype.itemsize * M.shape[1]))).ravel()
+        first, inverse = unique(rows, return_index=True, 
+                                return_inverse=True)[1:]
+        inverse = inverse.ravel()
+        
+        # Order of the first occurrence
+        order = argsort(first)
+        rank = empty(len(first), dtype=int64)
+        rank[order] = arange(len(first))
+        first = first[order]
+        inverse = rank[inverse]
+        
+        output = FuzzySet.from_block(
+            asfortranarray(self._block[first]), self.layout(),
+            dict((k, v.take(first)) for k, v in sparse.items()))
+        output.Weights = bincount(inverse, weights = self._weights,
+                                  minlength = len(first))
+        
+        if return_inverse:
+            return (output, inverse)
+        return output
+        
+    def _sparse_vars(self):
+        '''Dictionary with the sparse attributes (SparseFuzzyVar)'''
+        return dict((k, v) for k, v in self._vals.items() 
+                    if type(v) == SparseFuzzyVar)
+        
+    def _build_block(self, matrices):
+        '''Copies the matrices of the variables into a single block and 
+        rebinds every variable to its range of columns'''
+        
+        sizes = [m.shape[0] for m in matrices] + \
+                [len(v) for v in self._sparse_vars().values()]
+        if len(set(sizes)) > 1:
+            raise Exception("Sizes not compatible")
+            
+        # Variables stored in different types are joined as float64
+        if len(set(m.dtype for m in matrices)) > 1:
+            matrices = [dequantize(m) for m in matrices]
+            
+        if len(matrices) > 0:
+            self._bind_block(asfortranarray(hstack(matrices)))
+        else:
+            self._bind_block(zeros((sizes[0] if sizes else 0, 0), order="F"))
+            
+    def _bind_block(self, block):
+        '''Uses a block as the storage of the set. Every variable of the set
+        (they are not shared) is rebound to its range of columns, in the 
+        order of the attributes'''
+        
+        self._block = block
+        self._file = None
+        self._columns = dict()
+        start = 0
+        for k in self._dense_keys():
+            FVar = self._vals[k]
+            terms = list(FVar.keys())
+            stop = start + len(terms)
+            FVar._set_matrix(terms, self._block[:, start:stop])
+            
+            for c, t in enumerate(terms):
+                self._columns[(k, t)] = start + c
+                
+            start = stop
+            
+    @classmethod
+    def from_block(cls, block, layout, sparse = None):
+        '''Creates a FuzzySet on top of an existing block of memberships
+        (samples x terms), without copying it.
+        
+        Parameters
+        ==========
+        
+        - block : 2D array (column-major) with the memberships
+        - layout : List of pairs (attribute, terms), as returned by layout().
+                   The attributes that are not sparse are in the order of 
+                   the columns of the block
+        - sparse : Optional dictionary with the sparse attributes 
+                   (SparseFuzzyVar) of the layout
+        '''
+        
+        if sparse is None: sparse = dict()
+        
+        if sum(len(terms) for attr, terms in layout 
+               if not(attr in sparse)) != block.shape[1]:
+            raise Exception("Sizes not compatible")
+            
+        if any(len(v) != block.shape[0] for v in sparse.values()):
+            raise Exception("Sizes not compatible")
+        
+        output = cls()
+        for attr, terms in layout:
+            if attr in sparse:
+                output._vals[attr] = sparse[attr]
+            else:
+                output._vals[attr] = FuzzyVar.from_matrix(
+                    attr, terms, zeros((0, len(terms))))
+        output._bind_block(block)
+        
+        return output
+        
+    def layout(self):
+        '''Attributes and their terms. The attributes that are not sparse
+        are in the order of the columns of the block'''
+        return [(k, list(self._vals[k].keys())) for k in self._vals.keys()]
+        
+    def astype(self, dtype):
+        '''Returns a copy of the set with the memberships stored in another
+        type: float64, float32, uint8 or uint16 (see quantize).
+        
+        Usage
+        ==========
+        >>> fs8 = fs.astype("uint8")   # 1/8 of the memory of fs
+        '''
+        output = FuzzySet.from_block(asfortranarray(quantize(self._block, 
+                                                             dtype)),
+                                     self.layout(),
+                                     dict((k, v.astype(dtype)) for k, v 
+                                          in self._sparse_vars().items()))
+        output.Weights = self._weights
+        
+        return output
+        
+    def save(self, path):
+        '''Stores the set in the folder path: the block of memberships as a
+        column-major .npy file (so the terms of every attribute are a 
+        contiguous range of the file) and a JSON manifest with the 
+        attributes, their terms and their columns. The names of the 
+        attributes and terms must be JSON serializable.
+        
+        Usage
+        ==========
+        >>> fs.save("./airquality_fs")
+        >>> fs = FuzzySet.load("./airquality_fs")
+        '''
+        
+        os.makedirs(path, exist_ok = True)
+        save(os.path.join(path, "block.npy"), asfortranarray(self._block))
+        
+        attributes = []
+        sparse = self._sparse_vars()
+        for c, (attr, terms) in enumerate(self.layout()):
+            if attr in sparse:
+                # The pairs (term, membership) of the sparse attributes
+                files = dict(columns = "sparse_%d_columns.npy" % c,
+                             weights = "sparse_%d_weights.npy" % c)
+                save(os.path.join(path, files["columns"]), 
+                     sparse[attr]._columns)
+                save(os.path.join(path, files["weights"]), 
+                     sparse[attr]._weights)
+                attributes.append(dict(name = attr, terms = terms, 
+                                       sparse = files))
+            else:
+                attributes.append(dict(name = attr, terms = terms,
+                                       columns = [self._columns[(attr, t)] 
+                                                  for t in terms]))
+            
+        manifest = dict(version = 1, block = "block.npy", 
+                        samples = len(self), attributes = attributes)
+        
+        if self._weights is not None:
+            save(os.path.join(path, "weights.npy"), self._weights)
+            manifest["weights"] = "weights.npy"
+        
+        with open(os.path.join(path, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent = 1)
+            
+    @classmethod
+    def load(cls, path, mmap = True):
+        '''Loads a set stored with save. 
+        
+        With mmap (the default) the block is memory mapped read-only instead
+        of read: only the pages in use are loaded, and the processes that
+        load the same set share them.
+        '''
+        
+        with open(os.path.join(path, "manifest.json")) as f:
+            manifest = json.load(f)
+            
+        filename = os.path.join(path, manifest["block"])
+        block = load(filename, mmap_mode = "r" if mmap else None)
+        
+        if block.shape[0] != manifest["samples"]:
+            raise Exception("Sizes not compatible")
         
+        layout = [(a["name"], a["terms"]) for a in manifest["attributes"]]
+        
+        sparse = dict()
+        for a in manifest["attributes"]:
+            if "sparse" in a:
+                columns, weights = [
+                    load(os.path.join(path, a["sparse"][f]), 
+                         mmap_mode = "r" if mmap else None)
+                    for f in ["columns", "weights"]]
+                sparse[a["name"]] = SparseFuzzyVar(a["name"], a["terms"], 
+                                                   columns, weights)
+        
+        output = cls.from_block(block, layout, sparse)
+        
+        if "weights" in manifest:
+            output.Weights = load(os.path.join(path, manifest["weights"]))
+        
+        # The workers building a tree can map the same file
+        if mmap: output._file = filename
+        
+        return output
                 
     def __getitem__(self, attribute):
         return self._vals[attribute]
         
+    def _getblock(self):
+        return self._block
+        
+    Matrix = property(_getblock, doc="Block of memberships (samples x terms)")
+        
     def append(self, **kargs):
-        for k in kargs.keys():
-            self._vals[k].append(**kargs[k])
+        for k, FVar in self._sparse_vars().items():
+            FVar.append(**kargs[k])
+            
+        if self._weights is not None:
+            self._weights = concatenate([self._weights, [1.]])
+            
+        matrices = []
+        for k in self._dense_keys():
+            FVar = self._vals[k]
+            row = quantize([[kargs[k][t] for t in FVar.keys()]], 
+                           FVar.Matrix.dtype)
+            matrices.append(vstack([FVar.Matrix, row]))
+            
+        self._build_block(matrices)
             
     def __repr__(self):
         cad = ""
@@ -469,9 +1130,7 @@ class FuzzySet(object):
         return cad
         
     def __len__(self):
-        var = list(self._vals.keys())[0]
-        ks  = list(self[var].keys())[0]
-        return len(self._vals[var][ks])
+        return self._block.shape[0]
             
     
     def ambiguity(self, Attribute):
@@ -498,9 +1157,10 @@ class FuzzySet(object):
         IBV - Valencia (July 2014)   
         '''
         
-        FVars = self._vals[Attribute]
-        ambs = [f.ambiguity() for f in FVars]
+        ambs = row_ambiguity(self._vals[Attribute].Matrix)
         
+        if self._weights is not None:
+            return average(ambs, weights = self._weights)
         return mean(ambs)
         
     def mu(self, *args):
@@ -547,12 +1207,166 @@ class FuzzySet(object):
     def keys(self):
         return self._vals.keys()
         
+    def column_index(self, *args):
+        '''Returns the column of the block holding a given attribute and
+        member name. It accepts the same arguments as mu.'''
+        
+        if len(args) == 1:
+            Attribute, member = args[0].split(":")
+        elif len(args) == 2:
+            Attribute = args[0]
+            member = args[1]
+        else:
+            raise Exception("Number of parameters incorrect")
+            
+        return self._columns[(Attribute, member)]
+        
     def attributes(self):
         '''Return the attributes in the Fuzzy set'''
         return self._vals.keys()
         
+class FuzzyChunks(object):
+    '''Fuzzy observations split in chunks, that are loaded one at a time.
+    It stands for a FuzzySet too large to be held in memory (for instance,
+    to build a FuzzyTree out of core).
+    
+    The chunks are grouped in shards, that can be processed by different
+    processes. Every chunk must have the same attributes and terms.
+    
+    Parameters
+    ==========
+    
+    - *shards : Each shard is a list of chunks. A chunk is a FuzzySet, or
+                a function without arguments returning a FuzzySet (so that
+                it is only loaded when it is needed). The functions must be
+                picklable to process the shards in parallel
+                
+    Usage
+    ==========
+    
+    >>> from functools import partial
+    >>> chunks = FuzzyChunks([partial(load_chunk, "part1"), 
+                              partial(load_chunk, "part2")],
+                             [partial(load_chunk, "part3")])
+    >>> ft = FuzzyTree(chunks, Beta, Alpha, varRHS, varLHS, n_jobs = 2)
+    '''
+    
+    def __init__(self, *shards):
+        self._shards = [list(shard) for shard in shards]
+        
+    def _getshards(self):
+        return self._shards
+        
+    Shards = property(_getshards, doc="List of shards (lists of chunks)")
+        
+    def chunks(self, shard = None):
+        '''Iterates over the chunks (FuzzySets) of a shard, or of all the
+        shards if it is None'''
+        
+        if shard is None:
+            shards = self._shards
+        else:
+            shards = [shard]
+            
+        for s in shards:
+            for chunk in s:
+                yield _load_chunk(chunk)
+                
+    def __iter__(self):
+        return self.chunks()
+        
+    def layout(self):
+        '''Attributes and their terms, as in FuzzySet.layout'''
+        for chunk in self.chunks():
+            return chunk.layout()
+        
+    def __len__(self):
+        return sum(len(chunk) for chunk in self.chunks())
+        
+def _load_chunk(chunk):
+    '''A FuzzySet from a chunk of FuzzyChunks'''
+    if callable(chunk):
+        return chunk()
+    return chunk
+        
+# Types to store the memberships. The unsigned integers are a fixed point
+# quantization of [0, 1]: a membership is stored as round(mu * max code)
+STORAGE_TYPES = (dtype(float64), dtype(float32), dtype(uint8), dtype(uint16))
+
+def _scale(dt):
+    '''Maximum code of a quantized type of memberships (None for floats)'''
+    if dt in (uint8, uint16):
+        return iinfo(dt).max
+        
+def quantize(values, storage):
+    '''Memberships in a storage type. 
+    
+    The accuracy of each type is:
+        
+    - float64 : Exact. The default
+    - float32 : Relative error below 6e-8, half the memory. The sums of the
+                kernels are accumulated in float64
+    - uint16  : Absolute error below 8e-6 (1/131070), a quarter of the 
+                memory
+    - uint8   : Absolute error below 2e-3 (1/510), an eighth of the memory.
+                The sums of the kernels are exact (integers)
+                
+    Trees built on float32 or uint16 memberships are usually the same as 
+    on float64 ones. With uint8 the ambiguities may differ in the third 
+    decimal, enough to swap attributes of similar ambiguity or to move a 
+    truth level across Beta or a membership across Alfa.
+    
+    Parameters
+    ===========
+    - values : Memberships (in [0, 1]), in any type
+    - storage : Storage type
+    '''
+    
+    storage = dtype(storage)
+    if not(storage in STORAGE_TYPES):
+        raise Exception("Invalid type for the memberships")
+        
+    values = asarray(values)
+    if values.dtype == storage:
+        return values
+        
+    scale = _scale(storage)
+    if scale is None:
+        return asarray(dequantize(values), dtype=storage)
+    
+    return rint(clip(dequantize(values), 0., 1.) * scale).astype(storage)
+    
+def dequantize(values):
+    '''Memberships stored in any type as floats (see quantize). Float 
+    memberships are returned as they are'''
+    
+    values = asarray(values)
+    scale = _scale(values.dtype)
+    if scale is None:
+        if values.dtype.kind == "f":
+            return values
+        return asarray(values, dtype=float)
+        
+    return values / float(scale)
+    
+def sigma_counts(M, weights = None):
+    '''Sigma count of every column of a matrix of memberships 
+    (samples x terms), accumulated in float64 (or exactly for quantized
+    memberships). With weights, every object counts as many times as its
+    weight'''
+    
+    M = asarray(M)
+    scale = _scale(M.dtype)
+    if weights is not None:
+        return dot(asarray(weights, dtype=float), M) / float(scale or 1.)
+        
+    if scale is None:
+        return M.T.sum(axis=1, dtype=float64)
+        
+    return M.T.sum(axis=1, dtype=int64) / float(scale)
+        
 #membership function        
-def subsethood(A, B):
+def subsethood(A, B, weights = None):
     '''fuzzy subsethood  S(A, B)  measures the degree to which A is a 
     subset of B.
     
@@ -562,6 +1376,7 @@ def subsethood(A, B):
     ===========
     - A: FuzzyMembership
     - B: FuzzyMembership
+    - weights: Optional weights of the objects
     
     References
     ==========
@@ -580,16 +1395,219 @@ def subsethood(A, B):
     if (type(A) != FuzzyMembership) | (type(B) != FuzzyMembership):
         raise Exception("Invalid type")
         
-    val = A & B
+    # Accumulated in float64 (dot promotes float32 memberships)
+    if weights is not None:
+        weights = asarray(weights, dtype=float64)
+        
+    if weights is None:
+        sA = A.sum()
+        sval = minimum(A._value, B._value).sum(dtype=float64)
+    else:
+        sA = dot(weights, A._value)
+        sval = dot(weights, minimum(A._value, B._value))
+    
+    # An empty set A is not a subset of anything: NaN
+    with errstate(invalid="ignore"):
+        output = sval / sA
     
-    sval = sum(val._value)
-    sA = sum(A._value)
+    return output
+    
+def intersection_sums(E, C, max_elements = 2**24, weights = None):
+    '''Sigma counts of the intersection of a batch of evidences with every
+    class of a classification, computed as a single matrix operation:
+    
+    :math:'S_{jl} = \sum_i min(E_{ij}, C_{il})'
     
-    output = sval / sA
+    The evidences are processed in blocks (and the samples too, when one
+    evidence alone would exceed it), so that no more than max_elements 
+    intermediate values are held in memory at once. They are
+    computed in the storage type of E and C (see quantize) and accumulated
+    in float64, or exactly if both are quantized in the same type.
+    
+    Parameters
+    ===========
+    - E: Evidences. 2D array (samples x n_evidence) or a single 1D array
+    - C: Classification. 2D array (samples x n_classes)
+    - weights: Optional weights of the samples
     
+    Output
+    =========
+    - S: 2D array (n_evidence x n_classes)
+    '''
+    
+    E = asarray(E)
+    if E.ndim == 1: E = E[:, newaxis]
+    C = asarray(C)
+    if weights is not None: weights = asarray(weights, dtype=float64)
+    
+    # Both quantized alike: the minima are codes too
+    scale = _scale(E.dtype)
+    if (scale is None) or (E.dtype != C.dtype):
+        scale = None
+        C = dequantize(C)
+    
+    Et = E.T
+    Ct = C.T
+    nEv, nSamples = Et.shape
+    nClasses = Ct.shape[0]
+    
+    # Blocks of evidences and, if a single one does not fit, of samples
+    step = max(1, max_elements // max(1, nSamples * nClasses))
+    s_step = max(1, min(nSamples, max_elements // max(1, step * nClasses)))
+    
+    if (weights is None) and (scale is not None):
+        output = zeros((nEv, nClasses), dtype=int64)
+    else:
+        output = zeros((nEv, nClasses))
+    
+    for c in range(0, nEv, step):
+        for s in range(0, max(1, nSamples), s_step):
+            Es = Et[c:c+step, s:s+s_step]
+            Cs = Ct[:, s:s+s_step]
+            
+            if scale is None:
+                block = minimum(dequantize(Es)[:, newaxis, :], 
+                                Cs[newaxis, :, :])
+            else:
+                block = minimum(Es[:, newaxis, :], Cs[newaxis, :, :])
+                
+            if weights is not None:
+                output[c:c+step] += dot(block, weights[s:s+s_step]) / \
+                                    float(scale or 1.)
+            elif scale is None:
+                output[c:c+step] += block.sum(axis=2, dtype=float64)
+            else:
+                output[c:c+step] += block.sum(axis=2, dtype=int64)
+                
+    if output.dtype == int64:
+        output = output / float(scale)
+        
     return output
     
-def FuzzyEvidence(C, mu):
+def sparse_intersection_sums(P, C, mu = None, weights = None):
+    '''Sigma counts of the intersections of the terms of a SparseFuzzyVar 
+    with an evidence, alone and with every class of a classification, 
+    visiting only the stored pairs (term, membership):
+    
+    :math:'s_j = \sum_i min(mu_i, P_{ij})'
+    :math:'S_{jl} = \sum_i min(mu_i, P_{ij}, C_{il})'
+    
+    Parameters
+    ===========
+    - P : SparseFuzzyVar
+    - C : Classification. 2D array (samples x n_classes)
+    - mu: Evidence. 1D array, or None for no evidence
+    - weights: Optional weights of the samples
+    
+    Output
+    =========
+    - s : 1D array (n_terms)
+    - S : 2D array (n_terms x n_classes)
+    '''
+    
+    W = P._weights
+    if mu is not None:
+        W = minimum(W, quantize(mu, W.dtype)[:, newaxis])
+    
+    C = asarray(C)
+    scale = _scale(W.dtype)
+    if (scale is None) or (C.dtype != W.dtype):
+        scale = 1.
+        W, C = dequantize(W), dequantize(C)
+        
+    cols = P._columns.ravel()
+    nTerms = len(P.keys())
+    
+    if weights is None:
+        w = 1.
+    else:
+        w = asarray(weights, dtype=float)[:, newaxis]
+    
+    sums = bincount(cols, weights = (W * w).ravel(), minlength = nTerms) / scale
+    
+    inter = empty((nTerms, C.shape[1]))
+    for c in range(C.shape[1]):
+        inter[:, c] = bincount(cols, 
+                               weights = (minimum(W, C[:, c:c+1]) * w).ravel(),
+                               minlength = nTerms) / scale
+        
+    return (sums, inter)
+    
+def subsethood_matrix(E, C, weights = None):
+    '''Fuzzy subsethood of a batch of evidences in every class of a
+    classification (Definition 7 in Yuan et al. (1995)), that is
+    subsethood(E_j, C_l) for every pair, in one matrix operation.
+    
+    Evidences without any membership (empty sets) get NaN subsethoods.
+    
+    Parameters
+    ===========
+    - E: Evidences. 2D array (samples x n_evidence) or a single 1D array
+    - C: Classification. 2D array (samples x n_classes)
+    - weights: Optional weights of the samples
+    
+    Output
+    =========
+    - S: 2D array (n_evidence x n_classes)
+    
+    References
+    ==========
+    Yuan, Yufei, & Michael J. Shaw. "Induction of fuzzy decision trees". 
+    Fuzzy Sets and Systems 69, n.º 2 (27th January 1995): 125-39. 
+    doi:10.1016/0165-0114(94)00229-Z.
+    '''
+    
+    E = asarray(E)
+    if E.ndim == 1: E = E[:, newaxis]
+    
+    sE = sigma_counts(E, weights)[:, newaxis]
+    inter = intersection_sums(E, C, weights = weights)
+    
+    with errstate(divide="ignore", invalid="ignore"):
+        return where(sE == 0., float("nan"), inter / sE)
+    
+def row_ambiguity(M):
+    '''Ambiguity (nonspecificity) of every row of a matrix of memberships
+    (samples x terms), computed in one pass. It is the batched version of
+    FuzzyValue.ambiguity:
+    
+    :math:'E_a(Y) = g(\pi)=\sum_{i=1}^n {(pi_i^* - pi_{i+1}^*) \cdot ln(i)}'
+    
+    Rows are normalized to their maximum and sorted in decreasing order.
+    Rows without any membership (all zeros) have no ambiguity. The terms are
+    accumulated in the same order as in FuzzyValue.ambiguity, so both give
+    exactly the same values.
+    
+    Parameters
+    ===========
+    - M: A 2D array (samples x terms)
+    
+    References
+    ==========
+    Yuan, Yufei, & Michael J. Shaw. "Induction of fuzzy decision trees". 
+    Fuzzy Sets and Systems 69, n.º 2 (27th January 1995): 125-39. 
+    doi:10.1016/0165-0114(94)00229-Z.
+    '''
+    
+    M = dequantize(M)
+    nRows, nTerms = M.shape
+    
+    # Normalize the values of the rows to their maximum
+    max_val = M.max(axis=1)[:, newaxis]
+    with errstate(divide="ignore", invalid="ignore"):
+        vals = where(max_val == 0., 0., M / max_val)
+    
+    # Sorting from upside down and adding a zero
+    vals = hstack([-sort(-vals, axis=1), zeros((nRows, 1))])
+    
+    # Making the calculations
+    t = zeros(nRows)
+    for c in range(nTerms):
+        t += (vals[:, c] - vals[:, c+1]) * log(c + 1)
+        
+    return t
+    
+def FuzzyEvidence(C, mu, weights = None):
     '''Given fuzzy evidence E, the possibility of classifying an object
     according to a Clasification FuzzyVar.
     
@@ -602,6 +1620,7 @@ def FuzzyEvidence(C, mu):
     
     - C : The FuzzyVar classification variable
     - mu : The Fuzzy membership with the evidence
+    - weights : Optional weights of the objects
     
     References
     ==========
@@ -617,23 +1636,23 @@ def FuzzyEvidence(C, mu):
     IBV - Valencia (July 2014)   
     '''
     
+    return _normalize_evidence(FuzzyEvidence2(C, mu, weights))
+    
+def _normalize_evidence(Fz_ev):
+    '''Normalizes the possibilities of a FuzzyEvidence2 to its maximum'''
+    
     out = dict()
     maxim = 0.
     
-    for k in C.keys():
-        temp = subsethood(mu, C[k])
-        out[k] = temp
-        if temp > maxim : maxim = temp
+    for k in Fz_ev.keys():
+        if Fz_ev[k] > maxim : maxim = Fz_ev[k]
             
-    for k in C.keys():
-        out[k] = out[k] / maxim
+    for k in Fz_ev.keys():
+        out[k] = Fz_ev[k] / maxim
         
-    #Fout = FuzzyValue(**out)
-    
-    #return Fout.ambiguity()
     return FuzzyValue(**out)
     
-def FuzzyEvidence2(C, mu):
+def FuzzyEvidence2(C, mu, weights = None):
     '''Given fuzzy evidence E, the possibility of classifying an object
     according to a Clasification FuzzyVar.
     
@@ -647,6 +1666,7 @@ def FuzzyEvidence2(C, mu):
     
     - C : The FuzzyVar classification variable
     - mu : The Fuzzy membership with the evidence
+    - weights : Optional weights of the objects
     
     References
     ==========
@@ -662,20 +1682,12 @@ def FuzzyEvidence2(C, mu):
     IBV - Valencia (July 2014)   
     '''
     
-    out = dict()
-    maxim = 0.
+    # Empty evidences get NaN possibilities (see subsethood)
+    out = subsethood_matrix(mu._value, C.Matrix, weights)[0]
     
-    for k in C.keys():
-        temp = subsethood(mu, C[k])
-        out[k] = temp
-#        if temp > maxim : maxim = temp
-            
-    #Fout = FuzzyValue(**out)
-    
-    #return Fout.ambiguity()
-    return FuzzyValue(**out)
+    return FuzzyValue(**dict(zip(C.keys(), out)))
     
-def ClassAmbiguityWithP(C, P, mu):
+def ClassAmbiguityWithP(C, P, mu, cache = None, weights = None):
     '''
     The classification ambiguity with fuzzy partitioning
     P = [El . . . . . Ek} on fuzzy evidence F.
@@ -687,6 +1699,10 @@ def ClassAmbiguityWithP(C, P, mu):
     - C : Clasification FuzzyVar
     - P : Partitioning FuzzyVar
     - mu: Evidence (FuzzyMembership) (F in the original article)
+    - cache: Optional dictionary. If provided, it is filled with the 
+             intersection of every term of P with the evidence and its
+             FuzzyEvidence2: cache[term] = (FuzzyMembership, FuzzyValue)
+    - weights: Optional weights of the objects
     
     References
     ==========
@@ -701,57 +1717,209 @@ def ClassAmbiguityWithP(C, P, mu):
 
     IBV - Valencia (July 2014)   
     '''
+
+    splits = dict()
+    result, valid = BatchClassAmbiguityWithP(C, [P], mu, splits, weights)
+    
+    # Empty intersections: the ambiguity is not a number
+    if not valid[0]:
+        return float("nan")
         
-    if type(mu)!=FuzzyMembership:
+    if cache is not None: cache.update(splits[P.Name])
+        
+    return result[0]
+    
+def BatchClassAmbiguityWithP(C, Ps, mu = None, cache = None, weights = None):
+    '''
+    The classification ambiguity with fuzzy partitioning (Definition 12 in
+    Yuan et al. (1995)) of several candidate partitions on the same fuzzy 
+    evidence, scored in one pass over the stacked term matrices.
+    
+    Parameters
+    ==========    
+
+    - C : Clasification FuzzyVar
+    - Ps: List of partitioning FuzzyVars
+    - mu: Evidence (FuzzyMembership). None means no evidence at all (every
+          object fully belongs to it), as in ClassAmbiguity
+    - cache: Optional dictionary. If provided, it is filled with the 
+             intersections of every valid partition: 
+             cache[P.Name][term] = (FuzzyMembership, FuzzyValue) as in 
+             ClassAmbiguityWithP
+    - weights: Optional weights of the objects (for instance, the number of 
+               repetitions of each one, see FuzzySet.compress)
+    
+    Output
+    =========
+    
+    - ambiguities : Array with the ambiguity of each partition. It is 1.0
+                    for the partitions having an empty intersection with
+                    the evidence (NaN in ClassAmbiguityWithP)
+    - valid : Boolean array. False for the partitions with empty 
+              intersections
+    
+    References
+    ==========
+    Yuan, Yufei, & Michael J. Shaw. "Induction of fuzzy decision trees". 
+    Fuzzy Sets and Systems 69, n.º 2 (27th January 1995): 125-39. 
+    doi:10.1016/0165-0114(94)00229-Z.
+    '''
+        
+    if (mu is not None) and (type(mu)!=FuzzyMembership):
         raise Exception("Invalid type for the evidence")
         
-    if type(P)!=FuzzyVar:
-        raise Exception("Invalid type for the partitioning")
+    for P in Ps:
+        if not(type(P) in (FuzzyVar, SparseFuzzyVar)):
+            raise Exception("Invalid type for the partitioning")
 
-    if type(C)!=FuzzyVar:
+    if not(type(C) in (FuzzyVar, SparseFuzzyVar)):
         raise Exception("Invalid type for the classification")
+        
+    fs_C = C.Matrix
+    dense = [P for P in Ps if type(P) == FuzzyVar]
+    
+    # Intersection of evidence and dense partitions, one column per term. 
+    # The evidence is a minimum of stored memberships, so it is converted 
+    # back to their storage type without loss
+    if len(dense) > 0:
+        InSe = asfortranarray(hstack([P.Matrix for P in dense]))
+        if mu is not None:
+            InSe = minimum(InSe, quantize(mu._value, InSe.dtype)[:, newaxis], 
+                           order="F")
+        
+        d_sums = sigma_counts(InSe, weights)
+        d_inter = intersection_sums(InSe, fs_C, weights = weights)
     
+    # The sparse partitions visit their stored pairs only
+    sums, inter, sizes = [], [], []
+    start = 0
+    for P in Ps:
+        size = len(P.keys())
+        if type(P) == FuzzyVar:
+            sums.append(d_sums[start:start + size])
+            inter.append(d_inter[start:start + size])
+            start += size
+        else:
+            st = sparse_intersection_sums(P, fs_C, 
+                                          None if mu is None else mu._value,
+                                          weights)
+            sums.append(st[0])
+            inter.append(st[1])
+        sizes.append(size)
+        
+    sums = concatenate(sums)
+    inter = vstack(inter)
     
-    w = dict()
-    InSe = dict()
-    norm = 0.
+    output, valid = ClassAmbiguityFromStats(sizes, sums, inter)
     
-    for k in P.keys():
-        InSe[k] = P[k] & mu # Intersection of evidence and partition
-        w[k] = sum(InSe[k])
-        norm += w[k]
+    if cache is None:
+        return (output, valid)
         
-    for k in P.keys():
-        w[k] = w[k]/norm
+    # Subsethood of every intersection in every class (FuzzyEvidence2)
+    with errstate(divide="ignore", invalid="ignore"):
+        Sub = where(sums[:, newaxis] == 0., float("nan"), 
+                    inter / sums[:, newaxis])
+    
+    start = 0
+    d_start = 0
+    for c, P in enumerate(Ps):
+        stop = start + sizes[c]
+        
+        if valid[c]:
+            if type(P) == FuzzyVar:
+                values = InSe[:, d_start:d_start + sizes[c]]
+            else:
+                values = (P if mu is None else P & mu).Matrix
+                
+            cache[P.Name] = dict()
+            for t, k in enumerate(P.keys()):
+                if mu is None:
+                    label = (P.Name, k)
+                else:
+                    label = _and_label((P.Name, k), (mu._attribute, mu._mu))
+                    
+                cache[P.Name][k] = (
+                    FuzzyMembership(label[0], label[1], values[:, t]),
+                    FuzzyValue(**dict(zip(C.keys(), Sub[start + t]))))
+                    
+        if type(P) == FuzzyVar: d_start += sizes[c]
+        start = stop
         
-    w = FuzzyValue(**w)
+    return (output, valid)
+    
+def ClassAmbiguityFromStats(sizes, sums, inter):
+    '''
+    The classification ambiguity with fuzzy partitioning (Definition 12 in
+    Yuan et al. (1995)) of several partitions, from their sufficient 
+    statistics. These are sums over the objects, so they can be computed
+    by parts (chunks of data, shards in different processes) and added up.
     
-    #print w
-    #print InSe
+    Parameters
+    ==========    
 
-    result = 0.    
-    for k in InSe.keys():
-        result += w[k]*FuzzyEvidence(C, InSe[k]).ambiguity()
-        
-    return result
-        
+    - sizes: Number of terms of each partition
+    - sums : Sigma count of the intersection of the evidence with each term
+             of the partitions: sum(min(mu, P_k)), one per term
+    - inter: 2D array (terms x classes) with the sigma counts of the 
+             intersections with every class: sum(min(mu, P_k, C_c))
+    
+    Output
+    =========
     
-def ClassAmbiguity(C,P):
-    '''Classification ambiguity given a FuzzyVar'''
+    - ambiguities, valid : As in BatchClassAmbiguityWithP
     
-    w = dict()
-    norm = 0.
-    for k in P.keys():
-        w[k] = sum(P[k])
-        norm += w[k]
+    References
+    ==========
+    Yuan, Yufei, & Michael J. Shaw. "Induction of fuzzy decision trees". 
+    Fuzzy Sets and Systems 69, n.º 2 (27th January 1995): 125-39. 
+    doi:10.1016/0165-0114(94)00229-Z.
+    '''
+    
+    sums = asarray(sums, dtype=float)
+    
+    # Subsethood of every intersection in every class (FuzzyEvidence2),
+    # normalized to its maximum (FuzzyEvidence) and its ambiguity
+    with errstate(divide="ignore", invalid="ignore"):
+        Sub = where(sums[:, newaxis] == 0., float("nan"), 
+                    inter / sums[:, newaxis])
+        maxim = maximum(where(isnan(Sub), -inf, Sub).max(axis=1), 0.)
+        Amb = row_ambiguity(Sub / maxim[:, newaxis])
+    
+    output = empty(len(sizes))
+    valid = ones(len(sizes), dtype=bool)
+    
+    start = 0
+    for c, size in enumerate(sizes):
+        stop = start + size
+        
+        if (sums[start:stop] == 0.).any():
+            output[c] = 1.
+            valid[c] = False
+            start = stop
+            continue
+            
+        norm = 0.
+        for w in sums[start:stop]:
+            norm += w
+            
+        result = 0.
+        for w, a in zip(sums[start:stop], Amb[start:stop]):
+            result += (w / norm) * a
+        output[c] = result
         
-    for k in w.keys():
-        w[k] = w[k] / norm
+        start = stop
         
-    result = 0.
-    for k in P.keys():
-        result += w[k]*FuzzyEvidence(C, P[k]).ambiguity()
+    return (output, valid)
         
-    return result
     
+def ClassAmbiguity(C, P, weights = None):
+    '''Classification ambiguity given a FuzzyVar (and optionally the 
+    weights of the objects)'''
     
+    result, valid = BatchClassAmbiguityWithP(C, [P], weights = weights)
+    
+    # Empty terms: the ambiguity is not a number
+    if not valid[0]:
+        return float("nan")
+        
+    return result[0]
@@ -1,3 +1,4 @@
 from .FT_optimize import *
 from .FuzzyVars import *
 from .FuzzyTree import *
+from .FT_stream import *
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark of the classification of single records: per call latency
+of FuzzyTree.predict_one against building a FuzzySet and calling classify.
+It also compares the trees built with the memberships stored in each of the
+compact types of FuzzySet.astype, and fails if the float32 or uint16 rules
+are not those of float64.
+
+@author: jmbelda
+"""
+
+from FuzzyTree import *
+from timeit import repeat
+import pandas as pd
+
+#%% Reading the data and building the tree (as in demo.py)
+data = pd.read_csv("./demo/airquality.csv", index_col=0)
+
+variables = list(data.keys())
+
+varRHS = variables[1:5]
+varLHS = variables[0]
+
+fnVars = {}  # Dictionary of fuzzification functions
+fvVars = {}  # Dictionary of fuzzified variables
+
+levels = ["1. Low", "2. Medium", "3. High"]
+
+for v in  variables:
+    fnVars[v], fvVars[v] = percentile_partition(data[v], v, levels)
+
+fs = FuzzySet(*fvVars.values())
+
+ft = FuzzyTree(fs, 0.8, 0.8, varRHS, varLHS, fuzzifications = fnVars)
+
+#%% Records to classify, one by one
+records = data[varRHS].to_dict("records")
+rows = data[varRHS].values.tolist()
+
+def classify_set():
+    for r in records:
+        fv = [fnVars[v]([r[v]]) for v in varRHS]
+        ft.classify(FuzzySet(*fv))
+
+def classify_dict():
+    for r in records:
+        ft.predict_one(r)
+
+def classify_row():
+    for r in rows:
+        ft.predict_one(r)
+
+#%% Timing
+for name, fn in [("FuzzySet + classify", classify_set),
+                 ("predict_one (dict)", classify_dict),
+                 ("predict_one (list)", classify_row)]:
+    best = min(repeat(fn, number = 5, repeat = 5)) / (5 * len(records))
+    print("%-22s %10.1f us per record" % (name, best * 1e6))
+
+#%% Trees built on compact memberships
+print()
+classes = ft.classify(fs).Matrix
+
+for dt in ["float64", "float32", "uint16", "uint8"]:
+    fs_dt = fs.astype(dt)
+    ft_dt = FuzzyTree(fs_dt, 0.8, 0.8, varRHS, varLHS)
+    
+    same = [r.split(":")[0] for r in repr(ft_dt).splitlines()] == \
+           [r.split(":")[0] for r in repr(ft).splitlines()]
+    error = abs(ft_dt.classify(fs_dt).Matrix - classes).max()
+    
+    print("%-8s %8d bytes  same rules: %-5s  max error: %.1e" % 
+          (dt, fs_dt.Matrix.nbytes, same, error))
+    
+    # float32 and uint16 must give the tree of float64 (uint8 may not)
+    if dt in ("float32", "uint16") and not same:
+        raise Exception("The rules with %s differ from float64" % dt)
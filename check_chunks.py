@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Local check of the induction on data in chunks: the demo data are split in
+2 shards of 2 chunks each (FuzzyChunks), and the trees built on them, in
+this process and in 2 worker processes (one per shard), must be the same
+as the tree built on the whole FuzzySet.
+
+@author: jmbelda
+"""
+
+from FuzzyTree import *
+from numpy import arange, array_split
+import pandas as pd
+
+if __name__ == "__main__":
+    #%% Reading the data and fuzzifying them (as in demo.py)
+    data = pd.read_csv("./demo/airquality.csv", index_col=0)
+    
+    variables = list(data.keys())
+    
+    varRHS = variables[1:5]
+    varLHS = variables[0]
+    
+    fvVars = {}  # Dictionary of fuzzified variables
+    
+    levels = ["1. Low", "2. Medium", "3. High"]
+    
+    for v in  variables:
+        fn, fvVars[v] = percentile_partition(data[v], v, levels)
+    
+    fs = FuzzySet(*fvVars.values())
+    
+    #%% The shards: 2 of 2 chunks each
+    parts = [FuzzySet.from_block(fs.Matrix[rows], fs.layout()) 
+             for rows in array_split(arange(len(fs)), 4)]
+    chunks = FuzzyChunks(parts[:2], parts[2:])
+    
+    #%% The trees
+    for Beta, Alpha in [(0.8, 0.8), (0.7, 0.3), (0.9, 0.1), (0.95, 0.)]:
+        ft = FuzzyTree(fs, Beta, Alpha, varRHS, varLHS)
+        
+        for n_jobs in [1, 2]:
+            ft_chunks = FuzzyTree(chunks, Beta, Alpha, varRHS, varLHS, 
+                                  n_jobs = n_jobs)
+            
+            if repr(ft_chunks) != repr(ft):
+                raise Exception("The tree on chunks differs (Beta %s, "
+                                "Alpha %s, n_jobs %d)" % 
+                                (Beta, Alpha, n_jobs))
+                
+        print("Beta %.2f Alpha %.2f: %d rules, same trees" % 
+              (Beta, Alpha, len(repr(ft).splitlines())))